@@ -0,0 +1,221 @@
+"""
+Headless benchmark of the generate -> separate pipeline of the interface.
+
+Runs the functions called by the interface (generate_music, separate_tracks,
+separate_all_clips and the CSV/session logging) without starting the browser
+interface, for N simulated users in parallel. By default the models are replaced
+by fake backends producing synthetic audio with a configurable latency; --real
+uses MusicGen and Demucs.
+
+Only the models are faked: the handlers still build their gradio outputs, clips are
+encoded with audiocraft's audio_write and separated with demucs' apply_model, so
+gradio, audiocraft and demucs must be installed as for the interface.
+
+Example:
+    python benchmark_pipeline.py --users 10 --rounds 3 --output results.json
+    python benchmark_pipeline.py --users 10 --rounds 3 --compare results.json
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class FakeMusicGen:
+    """
+    Stand-in for audiocraft's MusicGen: returns sine tones after a fixed latency
+    plus a latency proportional to the seconds of audio generated.
+    """
+
+    sample_rate = 32000
+
+    def __init__(self, latency_s: float, latency_per_s: float):
+        self.latency_s = latency_s
+        self.latency_per_s = latency_per_s
+        self.duration = 10
+        # Used by the model pool to estimate the memory taken by the model
+        self.lm = torch.nn.Linear(256, 256)
+        self.compression_model = torch.nn.Identity()
+
+    def set_generation_params(self, duration: float = 10, **kwargs):
+        self.duration = duration
+
+    def _synthesize(self, count: int, seconds: float, offset: int = 0) -> torch.Tensor:
+        time.sleep(self.latency_s + self.latency_per_s * seconds)
+        t = (torch.arange(int(seconds * self.sample_rate)) + offset) / self.sample_rate
+        tones = [0.3 * torch.sin(2 * torch.pi * (220 + 110 * idx) * t) for idx in range(count)]
+        return torch.stack(tones)[:, None, :]
+
+    def generate(self, descriptions, progress: bool = False) -> torch.Tensor:
+        return self._synthesize(len(descriptions), self.duration)
+
+    def generate_continuation(self, prompt: torch.Tensor, prompt_sample_rate: int, descriptions=None,
+                              progress: bool = False) -> torch.Tensor:
+        new_seconds = self.duration - prompt.shape[-1] / self.sample_rate
+        continuation = self._synthesize(prompt.shape[0], new_seconds, offset=prompt.shape[-1])
+        return torch.cat([prompt, continuation], dim=-1)
+
+
+class FakeDemucs(torch.nn.Module):
+    """
+    Stand-in for the htdemucs_6s model, compatible with demucs.apply.apply_model: every
+    source gets an equal share of the mix, after a latency proportional to the audio length.
+    """
+
+    samplerate = 44100
+    audio_channels = 2
+    segment = 7.8
+    sources = ["drums", "bass", "other", "vocals", "guitar", "piano"]
+
+    def __init__(self, latency_per_s: float):
+        super().__init__()
+        self.latency_per_s = latency_per_s
+
+    def forward(self, mix: torch.Tensor) -> torch.Tensor:
+        time.sleep(self.latency_per_s * mix.shape[-1] / self.samplerate)
+        return mix[:, None].repeat(1, len(self.sources), 1, 1) / len(self.sources)
+
+
+# Size in bytes of all the files under a directory
+def disk_usage(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            file_path = os.path.join(root, name)
+            if not os.path.islink(file_path):
+                total += os.path.getsize(file_path)
+    return total
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 4)
+
+    return {
+        "count": len(ordered),
+        "mean": round(sum(ordered) / len(ordered), 4),
+        "p50": pick(0.50),
+        "p90": pick(0.90),
+        "p99": pick(0.99),
+        "max": round(ordered[-1], 4),
+    }
+
+
+def run_benchmark(args) -> dict:
+    workdir = args.workdir or tempfile.mkdtemp(prefix="benchmark_pipeline_")
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)  # The interface stores everything under ./Sessions
+    sys.path.insert(0, REPO_DIR)
+    import interface_code_ai_music_production as app
+
+    if not args.real:
+        app.model_pool.loader = lambda model_name: FakeMusicGen(args.generation_latency, args.generation_latency_per_s)
+        app.separation_engine.loader = lambda model_name: FakeDemucs(args.separation_latency_per_s)
+
+    latencies = {"generate_music": [], "separate_tracks": [], "separate_all_clips": [], "logging": []}
+    lock = threading.Lock()
+
+    def timed(name, function, *function_args):
+        start_time = time.perf_counter()
+        result = function(*function_args)
+        with lock:
+            latencies[name].append(time.perf_counter() - start_time)
+        return result
+
+    def user(user_id: int):
+        session = app.SessionState()  # Every simulated user is a separate browser session
+        for round_id in range(args.rounds):
+            description = f"benchmark user {user_id} round {round_id}"
+            outputs = timed("generate_music", lambda: list(app.generate_music(session, description, args.duration, args.model)))[-1]
+            clips = list(outputs[:3])
+            generation_id = session.displayed_generation_id
+            timed("separate_tracks", app.separate_tracks, session, clips[0], generation_id, 0)
+            timed("separate_all_clips", app.separate_all_clips, session, *clips, generation_id)
+            timed("logging", app.metrics_writer.write_csv, os.path.join("Sessions", "benchmark.csv"),
+                  [user_id, round_id, description])
+
+    disk_before = disk_usage(workdir)
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.users) as executor:
+        for future in [executor.submit(user, user_id) for user_id in range(args.users)]:
+            future.result()
+    flush_start_time = time.perf_counter()
+    app.metrics_writer.close()  # Include the time to drain the pending log rows
+    flush_time = time.perf_counter() - flush_start_time
+    wall_time = time.perf_counter() - start_time
+
+    return {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "wall_time_s": round(wall_time, 3),
+        "requests_per_s": round(args.users * args.rounds / wall_time, 3),
+        "log_flush_time_s": round(flush_time, 3),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "disk_bytes_written": disk_usage(workdir) - disk_before,
+        "latency_s": {name: percentiles(values) for name, values in latencies.items()},
+        # Mean time of each stage, from the histograms served by the metrics endpoint
+        "stage_mean_s": {
+            f"{operation}.{stage}": round(total / count, 4)
+            for (operation, stage), (_, total, count) in app.stage_metrics.histograms.items() if count
+        },
+    }
+
+
+# Ratios current / baseline of the main figures (below 1 is faster or smaller)
+def compare(results: dict, baseline: dict) -> dict:
+    comparison = {}
+    for key in ["wall_time_s", "peak_rss_mb", "disk_bytes_written"]:
+        if baseline.get(key):
+            comparison[key] = round(results[key] / baseline[key], 3)
+    for name, stats in results["latency_s"].items():
+        base = baseline.get("latency_s", {}).get(name, {})
+        if stats.get("p50") and base.get("p50"):
+            comparison[f"{name}_p50"] = round(stats["p50"] / base["p50"], 3)
+            comparison[f"{name}_p99"] = round(stats["p99"] / base["p99"], 3)
+    return comparison
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=4, help="simulated users running in parallel")
+    parser.add_argument("--rounds", type=int, default=2, help="generate/separate rounds per user")
+    parser.add_argument("--duration", type=int, default=5, help="seconds of audio per clip")
+    parser.add_argument("--model", default="small", help="musicgen variant")
+    parser.add_argument("--real", action="store_true", help="use the real MusicGen and Demucs models")
+    parser.add_argument("--generation-latency", type=float, default=0.5, help="fixed latency of the fake musicgen (s)")
+    parser.add_argument("--generation-latency-per-s", type=float, default=0.1, help="fake musicgen latency per second of audio")
+    parser.add_argument("--separation-latency-per-s", type=float, default=0.05, help="fake demucs latency per second of audio")
+    parser.add_argument("--workdir", help="directory where Sessions/ is written (default: a temporary directory)")
+    parser.add_argument("--output", help="write the results to this json file")
+    parser.add_argument("--compare", help="json results of a previous run to compare with")
+    args = parser.parse_args()
+
+    # Resolved before run_benchmark changes the working directory
+    output = os.path.abspath(args.output) if args.output else None
+    baseline_path = os.path.abspath(args.compare) if args.compare else None
+
+    results = run_benchmark(args)
+    if baseline_path:
+        with open(baseline_path) as file:
+            results["compared_to_baseline"] = compare(results, json.load(file))
+
+    print(json.dumps(results, indent=2))
+    if output:
+        with open(output, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,31 +1,165 @@
+from __future__ import annotations
+
 import os
-import torch
-import gradio as gr
-from audiocraft.models import MusicGen
-from audiocraft.data.audio import audio_write
-import subprocess as sp
-import sys
-from typing import List, Optional
+import argparse
+import functools
+import importlib
+from typing import Callable, Dict, Iterator, List, Optional
 from pathlib import Path
-import io
-import select
 import tempfile
 import shutil
 import logging
+import logging.handlers
+import atexit
+import queue
 import time
+STARTUP_TIME = time.perf_counter()  # Reference of the startup times reported at launch
+import wave
+import weakref
 import csv
+import re
+import sqlite3
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import hashlib
+import threading
+import itertools
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 
 
+class LazyImport:
+    """
+    Stands for a module (or one of its attributes) that is only imported when it is first used,
+    so importing this script (for tests or workers) and opening the port of the interface do not
+    wait for torch, audiocraft and demucs.
+    """
+
+    def __init__(self, module_name: str, attribute: Optional[str] = None):
+        self._module_name = module_name
+        self._attribute = attribute
+        self._target = None
+
+    def _resolve(self):
+        if self._target is None:
+            target = importlib.import_module(self._module_name)  # Thread-safe, imported once
+            self._target = getattr(target, self._attribute) if self._attribute else target
+        return self._target
+
+    def __getattr__(self, name: str):
+        return getattr(self._resolve(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+
+torch = LazyImport("torch")
+torchaudio = LazyImport("torchaudio")
+gr = LazyImport("gradio")
+MusicGen = LazyImport("audiocraft.models", "MusicGen")
+audio_write = LazyImport("audiocraft.data.audio", "audio_write")
+TorchAutocast = LazyImport("audiocraft.utils.autocast", "TorchAutocast")
+apply_model = LazyImport("demucs.apply", "apply_model")
+convert_audio = LazyImport("demucs.audio", "convert_audio")
+prevent_clip = LazyImport("demucs.audio", "prevent_clip")
+save_audio = LazyImport("demucs.audio", "save_audio")
+get_model = LazyImport("demucs.pretrained", "get_model")
+
+
 # Global variables
 current_language = "english"
-generation_count = 0 # Generation counters
 generated_files = []
-history = []
 SESSIONS_BASE_DIR = None  # Main directory for all sessions
-CURRENT_SESSION_DIR = None  # Directory for current session
-total_tracks_generated = 0  # Tracks generated in the session
-total_tracks_separated = 0  # Tracks user actually separated
+logging_lock = threading.Lock()  # Serializes the one-time logging setup
+session_names = itertools.count(1)  # Suffix keeping apart the folders of sessions opened in the same second
+live_sessions = weakref.WeakSet()  # Browser sessions whose state is still held by the interface
+SESSION_NOT_READY = "Error: the page is still loading, try again in a moment."  # Before demo.load creates the session
+NO_LIVE_AUDIO = (None,) * 3  # Yielded to the streaming players when there is no new audio (gr.update() breaks their stream)
+separation_job_ids = itertools.count(1)  # Ids of separation jobs, used in the logs
+
+# Request scheduling configuration
+GENERATION_CONCURRENCY = 4  # Generation jobs running (or waiting for their batch) at the same time
+SEPARATION_CONCURRENCY = 2  # Separation jobs running at the same time
+MAX_QUEUE_SIZE = 64  # Jobs waiting in the queue before new ones are rejected
+
+# Metrics writer configuration
+METRICS_QUEUE_SIZE = 10000  # Rows (and log records) buffered in memory, requests wait when it is full
+METRICS_FLUSH_INTERVAL_S = 2.0  # Max time a row waits before being written
+METRICS_FLUSH_ROWS = 500  # Pending rows that trigger an immediate flush
+
+# Startup configuration
+SERVER_PORT = 7860  # Port of the interface
+WARMUP = True  # Once the port is open, load the models and run a short generation and separation in the background
+WARMUP_DURATION_S = 1  # Length of the warm-up generation
+
+# Metrics endpoint configuration
+METRICS_PORT = 7861  # Prometheus-style metrics on http://localhost:7861/metrics, next to the interface (None to disable)
+LATENCY_BUCKETS_S = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]  # Histogram buckets
+
+# Worker configuration
+WORKERS = []  # Worker addresses ("host:port", each started with --worker host:port); empty runs the jobs in this process
+WORKER_AUTHKEY = os.environ.get("MUSIC_WORKER_AUTHKEY")  # Secret shared by front end and workers, required to use workers
+WORKER_HEALTH_INTERVAL_S = 10  # Time between pings of the workers
+
+# Model pool configuration
+MODEL_POOL_MEMORY_BUDGET_GB = 16  # Max memory taken by resident MusicGen models
+PRELOAD_MODELS = []  # Variants loaded at startup even without warm-up, e.g. ["small", "medium"] (the warm-up uses "small" if empty)
+
+# Generation batching configuration
+GENERATION_BATCH_WINDOW_S = 0.2  # Time waited for other requests with the same model and duration
+GENERATION_MAX_BATCH_REQUESTS = 4  # Max requests merged into one model.generate call (<= GENERATION_CONCURRENCY)
+
+# Sampling parameters passed to model.set_generation_params (musicgen defaults)
+GENERATION_PARAMS = {"use_sampling": True, "top_k": 250, "top_p": 0.0, "temperature": 1.0, "cfg_coef": 3.0}
+
+# Generation cache configuration (only used for generations with an explicit seed)
+GENERATION_CACHE_MAX_GB = 5  # Max disk space taken by cached clips
+
+# History configuration
+HISTORY_PAGE_SIZE = 50  # Generations shown per page of the History tab
+
+# Streaming generation configuration
+STREAMING_CHUNK_S = 5  # Seconds of audio generated (and sent to the interface) per step
+STREAMING_CONTEXT_S = 10  # Seconds of previous audio the next step continues from
+
+# Long-form generation configuration (clips longer than a single MusicGen pass)
+MAX_WINDOW_S = 30  # Longest clip MusicGen generates in a single pass
+MAX_DURATION_S = 300  # Maximum of the duration slider
+LONG_FORM_WINDOW_S = 20  # New audio generated per window
+LONG_FORM_CONTEXT_S = 10  # Tail of the previous windows each window continues from (window + context <= MAX_WINDOW_S)
+LONG_FORM_CROSSFADE_S = 0.5  # Crossfade between consecutive windows
+
+# Separation configuration
+SEPARATION_MODEL = "htdemucs_6s"  # Demucs model version
+SEPARATION_STEMS = ["drums", "bass", "guitar", "piano", "other"]  # Stems shown in the interface
+MAX_IN_MEMORY_CLIPS = 12  # Generated clips kept in memory for separation
+
+# Post-processing configuration
+ENCODE_WORKERS = 4  # Threads encoding and writing clips and stems in parallel, in the background
+LOUDNESS_HEADROOM_DB = 14  # Generated clips are normalized to -14 LUFS (as audio_write does)
+AUDIO_FORMAT = "wav"  # Format of the generated clips: "wav", "flac", "mp3" or "ogg"
+STEMS_FORMAT = "wav"  # Format of the separated stems: "wav", "flac" or "mp3"
+
+# Storage lifecycle configuration (background manager of the Sessions/ tree)
+STORAGE_SCAN_INTERVAL_S = 600  # Time between two passes of the storage manager (None to disable it)
+STORAGE_GLOBAL_QUOTA_GB = 50  # Max disk space taken by Sessions/
+STORAGE_SESSION_QUOTA_GB = 5  # Max disk space taken by the audio of one session
+STORAGE_MAX_AGE_DAYS = 30  # Clips and stems not used for longer are deleted (None to keep them)
+STORAGE_COLD_AFTER_H = 24  # WAV files not used for longer are transcoded to FLAC (None to keep them as WAV)
+STORAGE_PROTECT_H = 1  # Files used more recently are never transcoded or deleted
+
+# CPU performance configuration (only used when no GPU is available)
+CPU_INTRA_OP_THREADS = None  # Threads used inside each operation (None: torch default)
+CPU_INTER_OP_THREADS = None  # Threads running independent operations in parallel (None: torch default)
+CPU_PRECISION = "fp32"  # "fp32", "bf16" (autocast) or "int8" (dynamic quantization of the linear layers)
+CPU_COMPILE = False  # Compile the models with torch.compile
+CPU_PIN_THREADS = False  # Run generation and separation workers on disjoint sets of cores
+SEPARATION_OVERLAP = 0.25  # Overlap between the chunks the model is applied to
+SEPARATION_NUM_WORKERS = 0  # Extra threads applying the model to chunks in parallel (0: as demucs -j 0, torch's own threads only)
 
 #N.B. it is possible to add support for further languages
 # Text for the menu 
@@ -48,7 +182,7 @@ texts = {
 
 
 # Change language function
-def change_language():
+def change_language(session: "SessionState"):
     global current_language
     current_language = "english"
     updated_texts = texts[current_language]
@@ -69,7 +203,7 @@ def change_language():
         gr.update(label=updated_texts["duration_label"]),
         gr.update(value=updated_texts["generate_button"]),
         gr.update(value=updated_texts["separation_title"]),
-        gr.update(value=f"{updated_texts['counter_label']} {generation_count}"),
+        gr.update(value=f"{updated_texts['counter_label']} {session.last_generation_id if session else 0}"),
         *separate_buttons_updates,
         gr.update(value="Separate All"),  
     )
@@ -79,140 +213,1356 @@ def change_language():
 def update_texts():
     return texts[current_language]
 
-# Computational device configuration (CUDA or CPU)
-device = "cuda" if torch.cuda.is_available() else "cpu"
+# Computational device configuration (CUDA or CPU), decided when a model first needs it
+@functools.lru_cache(maxsize=None)
+def get_device() -> str:
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+# Sets the number of torch threads, must run before any model is used
+def configure_cpu_threads():
+    if CPU_INTRA_OP_THREADS:
+        torch.set_num_threads(CPU_INTRA_OP_THREADS)
+    if CPU_INTER_OP_THREADS:
+        torch.set_num_interop_threads(CPU_INTER_OP_THREADS)
+
+
+# Cores reserved to generation and separation workers, split in proportion to their concurrency
+def cpu_layout() -> Dict[str, set]:
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    split = max(1, round(len(cores) * GENERATION_CONCURRENCY / (GENERATION_CONCURRENCY + SEPARATION_CONCURRENCY)))
+    return {"generation": set(cores[:split]), "separation": set(cores[split:] or cores)}
+
+
+def pin_cpu_role(role: str):
+    """
+    Runs once in each long-lived thread of a role: restricts it to the cores of the role and
+    runs each torch operation on as many threads as the role has cores per concurrent job.
+    """
+    cores = cpu_layout()[role]
+    concurrency = GENERATION_CONCURRENCY if role == "generation" else SEPARATION_CONCURRENCY
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(max(1, len(cores) // concurrency))
+
+
+cpu_role_executors = {}  # Role -> threads pinned to the cores of the role, created on first use
+cpu_role_lock = threading.Lock()
+
+
+def run_inference(fn: Callable, *args):
+    with torch.inference_mode():
+        return fn(*args)
+
+
+def cpu_call(role: str, fn: Callable, *args):
+    """
+    Runs fn(*args) in inference mode. With CPU_PIN_THREADS, it runs on a thread of its role
+    ("generation" or "separation") set up by pin_cpu_role, so parallel generation and separation
+    jobs do not compete for the same cores. Thread settings are never changed by request threads.
+    """
+    if get_device() == "cpu" and CPU_PIN_THREADS and hasattr(os, "sched_setaffinity"):
+        with cpu_role_lock:
+            if role not in cpu_role_executors:
+                concurrency = GENERATION_CONCURRENCY if role == "generation" else SEPARATION_CONCURRENCY
+                cpu_role_executors[role] = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f"cpu-{role}",
+                                                              initializer=pin_cpu_role, initargs=(role,))
+        return cpu_role_executors[role].submit(run_inference, fn, *args).result()
+    return run_inference(fn, *args)
+
+
+# Applies the CPU_PRECISION and CPU_COMPILE settings to a musicgen model
+def accelerate_musicgen(model: MusicGen) -> MusicGen:
+    if CPU_PRECISION == "int8":
+        model.lm = torch.ao.quantization.quantize_dynamic(model.lm, {torch.nn.Linear}, dtype=torch.qint8)
+    elif CPU_PRECISION == "bf16":
+        # Musicgen runs its language model under model.autocast, which is disabled on CPU by default
+        model.autocast = TorchAutocast(enabled=True, device_type="cpu", dtype=torch.bfloat16)
+    if CPU_COMPILE:
+        model.lm.forward = torch.compile(model.lm.forward, dynamic=True)
+    return model
+
+
+# Applies the CPU_PRECISION and CPU_COMPILE settings to a demucs model (bf16 is applied when separating)
+def accelerate_demucs(model):
+    if hasattr(model, "models"):  # htdemucs_6s is a bag of models
+        for idx, submodel in enumerate(model.models):
+            model.models[idx] = accelerate_demucs(submodel)
+        return model
+    if CPU_PRECISION == "int8":
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if CPU_COMPILE:
+        model.forward = torch.compile(model.forward, dynamic=True)
+    return model
 
 # Main directory where data are stored
 BASE_DIR = ""
 
+class MetricsWriter:
+    """
+    Background thread that writes log records, CSV rows and session store rows off the
+    request path. Everything goes through a bounded queue and is flushed in batches (each
+    file is opened once per batch, each statement runs once per batch) on a timer or when
+    enough rows are pending. Pending rows are flushed at exit.
+    """
+
+    def __init__(self, max_size: int, flush_interval_s: float, flush_rows: int):
+        self.queue = queue.Queue(maxsize=max_size)
+        self.flush_interval_s = flush_interval_s
+        self.flush_rows = flush_rows
+        self.log_handlers = []
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="metrics-writer", daemon=True)
+                self.thread.start()
+                atexit.register(self.close)
+
+    def write_csv(self, path: str, row: list, header: Optional[list] = None):
+        """
+        Appends a row to a CSV file, the header is written first if the file is empty.
+        """
+        self.start()
+        self.queue.put(("csv", (path, tuple(header) if header else None), row))
+
+    def execute(self, store, statement: str, params: tuple):
+        """
+        Runs an SQL statement on the session store.
+        """
+        self.start()
+        self.queue.put(("sql", (store, statement), params))
+
+    def log(self, record: logging.LogRecord):
+        self.start()
+        self.queue.put(("log", None, record))
+
+    def close(self):
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.queue.put(None)
+            thread.join()
+
+    def _run(self):
+        running = True
+        while running:
+            batch = []
+            deadline = time.time() + self.flush_interval_s
+            while len(batch) < self.flush_rows:
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+            if batch:
+                with stage_metrics.span("logging", "flush"):
+                    self._flush(batch)
+
+    def _flush(self, batch: list):
+        # Coalesce the rows by destination, keeping their order
+        groups = OrderedDict()
+        for kind, target, payload in batch:
+            groups.setdefault((kind, target), []).append(payload)
+
+        for (kind, target), payloads in groups.items():
+            try:
+                if kind == "log":
+                    for record in payloads:
+                        for handler in self.log_handlers:
+                            handler.handle(record)
+                elif kind == "csv":
+                    path, header = target
+                    file_exists = os.path.exists(path) and os.stat(path).st_size > 0
+                    with open(path, mode="a", newline="") as file:
+                        writer = csv.writer(file)
+                        if header and not file_exists:
+                            writer.writerow(header)
+                        writer.writerows(payloads)
+                elif kind == "sql":
+                    store, statement = target
+                    store.execute_many(statement, payloads)
+            except Exception as e:
+                print(f" Error writing {kind} rows to {target}: {e}")
+
+
+metrics_writer = MetricsWriter(METRICS_QUEUE_SIZE, METRICS_FLUSH_INTERVAL_S, METRICS_FLUSH_ROWS)
+
+
+class StageMetrics:
+    """
+    Histograms of the time spent in each stage of generation and separation (queue wait,
+    model fetch, inference, encoding, disk write...), served in the Prometheus text format.
+    """
+
+    def __init__(self, buckets: List[float]):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.histograms = OrderedDict()  # (operation, stage) -> [counts per bucket, sum, count]
+
+    def observe(self, operation: str, stage: str, seconds: float):
+        with self.lock:
+            histogram = self.histograms.setdefault((operation, stage), [[0] * len(self.buckets), 0.0, 0])
+            for idx, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[0][idx] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    @contextmanager
+    def span(self, operation: str, stage: str):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(operation, stage, time.perf_counter() - start_time)
+
+    def render(self) -> str:
+        lines = [
+            "# HELP pipeline_stage_seconds Time spent in each stage of generation and separation",
+            "# TYPE pipeline_stage_seconds histogram",
+        ]
+        with self.lock:
+            for (operation, stage), (counts, total, count) in self.histograms.items():
+                labels = f'operation="{operation}",stage="{stage}"'
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f'pipeline_stage_seconds_bucket{{{labels},le="{bound}"}} {bucket_count}')
+                lines.append(f'pipeline_stage_seconds_bucket{{{labels},le="+Inf"}} {count}')
+                lines.append(f"pipeline_stage_seconds_sum{{{labels}}} {total}")
+                lines.append(f"pipeline_stage_seconds_count{{{labels}}} {count}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int) -> ThreadingHTTPServer:
+        """
+        Serves the metrics on http://localhost:{port}/metrics from a background thread.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # Scrapes are not worth a line in the console
+
+        server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        threading.Thread(target=server.serve_forever, name="metrics-endpoint", daemon=True).start()
+        print(f"Metrics served on http://127.0.0.1:{port}/metrics")
+        return server
+
+
+stage_metrics = StageMetrics(LATENCY_BUCKETS_S)
+
+
+# Time a request was sent, recorded by a step outside the gradio queue just before the request enters it
+def enqueue_time() -> float:
+    return time.time()
+
+
+def observe_queue_wait(operation: str, enqueued_at: Optional[float]):
+    if enqueued_at is not None:
+        stage_metrics.observe(operation, "queue_wait", time.time() - enqueued_at)
+
+
+# Logging handler that hands the records to the metrics writer instead of writing them itself
+class MetricsWriterHandler(logging.handlers.QueueHandler):
+    def __init__(self, writer: MetricsWriter):
+        super().__init__(None)
+        self.writer = writer
+
+    def enqueue(self, record: logging.LogRecord):
+        self.writer.log(record)
+
+
+LOG_FORMATTER = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+# New columns go at the end: existing CSV files keep their header, older columns must not move
+CSV_HEADER = ["Generation ID", "Timestamp", "Description", "Duration (s)", "Model",
+              "Processing Time (s)", "Generated Files", "Time To First Audio (s)"]
+
+
+# Creates a CSV file with its header, unless it already exists
+def create_csv(csv_file: str):
+    if not os.path.exists(csv_file):  # Only write headers if file doesn't exist
+        with open(csv_file, mode="w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(CSV_HEADER)
+
+
+class SessionLogHandler(logging.Handler):
+    """
+    Writes each record logged for a browser session to the session.log of that session.
+    The file is only open while a record is written, so open sessions do not hold file descriptors.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.setFormatter(LOG_FORMATTER)
+        self.files = {}  # Session name -> path of its log
+
+    def add_session(self, name: str, log_file: str):
+        self.files[name] = log_file
+
+    def remove_session(self, name: str):
+        self.files.pop(name, None)
+
+    def emit(self, record: logging.LogRecord):
+        log_file = self.files.get(getattr(record, "session", None))
+        if log_file is None:
+            return
+        try:
+            with open(log_file, "a") as file:
+                file.write(self.format(record) + "\n")
+        except Exception:
+            self.handleError(record)
+
+
+session_log_handler = SessionLogHandler()
+
+
+# Sets up the logs shared by all sessions, once per process
 def setup_logging():
-    global CURRENT_SESSION_DIR
+    global SESSIONS_BASE_DIR
 
-    # Ensure the main Sessions/ directory exists
-    SESSIONS_BASE_DIR = os.path.join(BASE_DIR, "Sessions")
-    os.makedirs(SESSIONS_BASE_DIR, exist_ok=True)
+    with logging_lock:
+        if SESSIONS_BASE_DIR is not None:
+            return
 
-    # Create the session folder INSIDE Sessions/
-    now = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    CURRENT_SESSION_DIR = os.path.join(SESSIONS_BASE_DIR, f"session_{now}")
-    os.makedirs(CURRENT_SESSION_DIR, exist_ok=True)
+        # Ensure the main Sessions/ directory exists
+        sessions_dir = os.path.join(BASE_DIR, "Sessions")
+        os.makedirs(sessions_dir, exist_ok=True)
 
-    # Set up logging inside the session folder
-    log_file = os.path.join(CURRENT_SESSION_DIR, "session.log")
+        # Records of every session (and of the shared model workers) go to server.log,
+        # those of a session also to its own session.log. Both are written by the metrics writer thread
+        file_handler = logging.FileHandler(os.path.join(sessions_dir, "server.log"))
+        file_handler.setFormatter(LOG_FORMATTER)
+        metrics_writer.log_handlers.extend([file_handler, session_log_handler])
+        root_logger = logging.getLogger()
+        root_logger.setLevel(logging.INFO)
+        root_logger.addHandler(MetricsWriterHandler(metrics_writer))
 
+        global_csv = os.path.join(sessions_dir, "all_sessions.csv")  # Global CSV
+        create_csv(global_csv)
+        SESSIONS_BASE_DIR = sessions_dir
 
-    logging.basicConfig(
-        filename=log_file,
-        level=logging.INFO,
-        format="%(asctime)s - %(levelname)s - %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S",
-    )
+    logging.info(f"=== Server started === Global CSV log file: {global_csv}")
 
-    logging.info("=== New session started ===")
 
-    # Create per-session CSV
-    session_csv = os.path.join(CURRENT_SESSION_DIR, "session.csv")
-    global_csv = os.path.join(SESSIONS_BASE_DIR, "all_sessions.csv")  # Global CSV
+class SessionState:
+    """
+    State of one browser session, kept in gr.State: its folder under Sessions/ (created with the
+    first generation), generation ids and track counters. Handlers receive it explicitly, so
+    concurrent users never share a folder or a counter.
+    """
 
-    
-    for csv_file in [session_csv, global_csv]:
-        if not os.path.exists(csv_file):  # Only write headers if file doesn't exist
-            with open(csv_file, mode="w", newline="") as file:
-                writer = csv.writer(file)
-                writer.writerow(["Generation ID", "Timestamp", "Description", "Duration (s)", "Model", 
-                             "Processing Time (s)", "Generated Files"])
+    def __init__(self):
+        now = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        self.name = f"session_{now}_{next(session_names)}"
+        self.dir = os.path.join(BASE_DIR, "Sessions", self.name)
+        self.log = logging.LoggerAdapter(logging.getLogger(), {"session": self.name})
+        self.generation_ids = itertools.count(1)  # next() hands out each id once, without a lock
+        self.last_generation_id = 0  # Latest generation started, shown by the counter
+        self.displayed_generation_id = 0  # Generation whose clips are shown in the Generation tab
+        self.pending_separations = {}  # Generation id -> (automatic separations still to show, start time)
+        self.tracks_generated = 0  # Tracks generated in the session
+        self.tracks_separated = 0  # Tracks user actually separated
+        self.lock = threading.Lock()  # Protects the track counters of this session only
+        self.started = False
+        live_sessions.add(self)
+
+    def start(self):
+        """
+        Creates the session folder, its log and its CSV, before the first generation.
+        """
+        with self.lock:
+            if self.started:
+                return
+            setup_logging()
+            os.makedirs(self.dir, exist_ok=True)
+            session_log_handler.add_session(self.name, os.path.join(self.dir, "session.log"))
+            weakref.finalize(self, session_log_handler.remove_session, self.name)  # When gradio drops the state
+            create_csv(os.path.join(self.dir, "session.csv"))
+            self.started = True
+        self.log.info("=== New session started ===")
+
+    def next_generation_id(self) -> int:
+        generation_id = next(self.generation_ids)
+        self.last_generation_id = max(self.last_generation_id, generation_id)
+        return generation_id
+
+    def count_tracks(self, generated: int = 0, separated: int = 0) -> tuple[int, int]:
+        """
+        Adds to the track counters, returns the totals (generated, separated) of the session.
+        """
+        with self.lock:
+            self.tracks_generated += generated
+            self.tracks_separated += separated
+            return self.tracks_generated, self.tracks_separated
+
+
+class SessionStore:
+    """
+    SQLite store (WAL mode) of the metrics of all sessions. Generations, separations and
+    session summaries are kept in separate tables; running aggregates are kept in memory
+    and in the aggregates table, so logging a request never reads the history of previous
+    sessions. Rows are written by the metrics writer, in batches. The CSV files are still
+    written, as an export of the same data.
+
+    The history table indexes every generation of every session by a global id, with a full
+    text index of the descriptions (when SQLite has FTS5). It is built from the Sessions/ tree
+    the first time the store is opened, then a row is added by each generation.
+    """
 
-    logging.info(f"CSV log files created: {session_csv}, {global_csv}")
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS generations (
+            session TEXT, generation_id INTEGER, timestamp TEXT, description TEXT, duration REAL,
+            model TEXT, processing_time REAL, time_to_first_audio REAL, files TEXT
+        );
+        CREATE TABLE IF NOT EXISTS separations (
+            session TEXT, generation_id INTEGER, timestamp TEXT, clips INTEGER, cached_clips INTEGER,
+            processing_time REAL
+        );
+        CREATE TABLE IF NOT EXISTS session_summaries (
+            session TEXT, timestamp TEXT, tracks_generated INTEGER, tracks_separated INTEGER,
+            separation_usage_rate REAL
+        );
+        CREATE TABLE IF NOT EXISTS aggregates (
+            name TEXT PRIMARY KEY, total REAL NOT NULL, count INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS separation_cache (
+            fingerprint TEXT PRIMARY KEY, stems_dir TEXT NOT NULL
+        );
+    """
+
+    HISTORY_SCHEMA = """
+        CREATE TABLE history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, session TEXT, generation_id INTEGER, timestamp TEXT,
+            description TEXT, duration REAL, model TEXT, files TEXT, UNIQUE (session, generation_id)
+        )
+    """
+
+    HISTORY_FTS_SCHEMA = [
+        "CREATE VIRTUAL TABLE history_fts USING fts5(description, content='history', content_rowid='id')",
+        """CREATE TRIGGER history_fts_insert AFTER INSERT ON history BEGIN
+            INSERT INTO history_fts (rowid, description) VALUES (new.id, new.description);
+        END""",
+    ]
+
+    def __init__(self, db_path: str, writer: MetricsWriter):
+        self.db_path = db_path
+        self.writer = writer
+        self.lock = threading.Lock()
+        self.connection = None
+        self.aggregates = None  # name -> [total, count], read once from the database
+        self.full_text = False  # Whether the descriptions have a full text index
+
+    def _connect(self) -> sqlite3.Connection:
+        # Called with self.lock held
+        if self.connection is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            connection = sqlite3.connect(self.db_path, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(self.SCHEMA)
+            tables = {name for name, in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            if "history" not in tables:
+                self._build_history(connection)
+                tables = {name for name, in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            self.full_text = "history_fts" in tables
+            self.connection = connection
+        return self.connection
+
+    def _build_history(self, connection: sqlite3.Connection):
+        """
+        Creates the history table from the generations found in the Sessions/ tree, in one transaction.
+        """
+        start_time = time.time()
+        rows = []
+        sessions_dir = os.path.dirname(self.db_path) or "."
+        for session_entry in os.scandir(sessions_dir):
+            if not session_entry.is_dir() or not session_entry.name.startswith("session_"):
+                continue
+            # Description, duration and model of each generation, from the session CSV
+            details = {}
+            session_csv = os.path.join(session_entry.path, "session.csv")
+            if os.path.exists(session_csv):
+                with open(session_csv, newline="") as file:
+                    for row in csv.reader(file):
+                        if len(row) >= 5 and row[0].isdigit():
+                            details[int(row[0])] = row[1:5]
+            for entry in os.scandir(session_entry.path):
+                match = re.fullmatch(r"generation_(\d+)", entry.name)
+                if not match or not entry.is_dir():
+                    continue
+                generation_id = int(match.group(1))
+                files = sorted(os.path.join(entry.path, name) for name in os.listdir(entry.path) if name.startswith("output_"))
+                timestamp = datetime.fromtimestamp(entry.stat().st_mtime).strftime("%Y-%m-%d %H:%M:%S")
+                timestamp, description, duration, model_name = details.get(generation_id, [timestamp, "", None, None])
+                rows.append((session_entry.name, generation_id, timestamp, description, duration, model_name, json.dumps(files)))
+        rows.sort(key=lambda row: (row[2], row[0], row[1]))  # Ids follow the order of the generations
+
+        with connection:
+            connection.execute(self.HISTORY_SCHEMA)
+            try:
+                for statement in self.HISTORY_FTS_SCHEMA:
+                    connection.execute(statement)
+            except sqlite3.OperationalError as e:
+                print(f" Full text search not available, history searched with LIKE: {e}")
+            connection.executemany(
+                "INSERT OR IGNORE INTO history (session, generation_id, timestamp, description, duration, model, files) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+            )
+        print(f"History index built from {sessions_dir}: {len(rows)} generations in {time.time() - start_time:.2f} seconds")
+
+    def open(self):
+        """
+        Opens the database, building the history index if it does not exist yet.
+        """
+        with self.lock:
+            self._connect()
+
+    def execute_many(self, statement: str, rows: list):
+        """
+        Runs a statement for a batch of rows in a single transaction (called by the metrics writer).
+        """
+        with self.lock:
+            connection = self._connect()
+            with connection:
+                connection.executemany(statement, rows)
+
+    def add_generation(self, session: str, generation_id: int, timestamp: str, description: str, duration: float,
+                       model_name: str, processing_time: float, time_to_first_audio: float, files: List[str]):
+        """
+        Stores the metrics of a generation and adds it to the history. Both rows are written by the
+        metrics writer, so the History tab shows the generation within METRICS_FLUSH_INTERVAL_S.
+        """
+        files = json.dumps([str(file) for file in files])
+        self.writer.execute(self, "INSERT INTO generations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", (
+            session, generation_id, timestamp, description, duration, model_name,
+            processing_time, time_to_first_audio, files
+        ))
+        self.writer.execute(self, (
+            "INSERT OR IGNORE INTO history (session, generation_id, timestamp, description, duration, model, files) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)"
+        ), (session, generation_id, timestamp, description, duration, model_name, files))
+
+    def history_page(self, query: str, page: int, page_size: int) -> tuple[list, int]:
+        """
+        Returns the rows (id, session, timestamp, description) of a page of the history, newest
+        first, and the number of generations matching the query. Each word of the query matches
+        the descriptions containing a word starting with it.
+        """
+        words = re.findall(r"\w+", query)
+        with self.lock:
+            connection = self._connect()
+            if not words:
+                condition, params = "", []
+            elif self.full_text:
+                condition = "WHERE id IN (SELECT rowid FROM history_fts WHERE history_fts MATCH ?)"
+                params = [" AND ".join(f'"{word}"*' for word in words)]
+            else:
+                condition = "WHERE " + " AND ".join("description LIKE ?" for _ in words)
+                params = [f"%{word}%" for word in words]
+            total = connection.execute(f"SELECT count(*) FROM history {condition}", params).fetchone()[0]
+            rows = connection.execute(
+                f"SELECT id, session, timestamp, description FROM history {condition} ORDER BY id DESC LIMIT ? OFFSET ?",
+                params + [page_size, page * page_size]
+            ).fetchall()
+        return rows, total
+
+    def history_files(self, history_id: int) -> List[str]:
+        """
+        Returns the clips of a generation of the history (empty if the id does not exist).
+        """
+        with self.lock:
+            row = self._connect().execute("SELECT files FROM history WHERE id = ?", (history_id,)).fetchone()
+        return json.loads(row[0]) if row else []
+
+    def cached_stems(self, fingerprint: str) -> Optional[str]:
+        """
+        Returns the directory of the stems of the fingerprinted audio, if it was separated.
+        """
+        with self.lock:
+            row = self._connect().execute(
+                "SELECT stems_dir FROM separation_cache WHERE fingerprint = ?", (fingerprint,)
+            ).fetchone()
+        return row[0] if row else None
+
+    STORE_STEMS = ("INSERT INTO separation_cache VALUES (?, ?) "
+                   "ON CONFLICT(fingerprint) DO UPDATE SET stems_dir = excluded.stems_dir")
+
+    def store_stems(self, fingerprint: str, stems_dir: str):
+        self.writer.execute(self, self.STORE_STEMS, (fingerprint, stems_dir))
+
+    def forget_stems(self, fingerprint: str, stems_dir: str):
+        # Only if it still points to the directory found incomplete, a newer separation may have replaced it
+        self.writer.execute(self, "DELETE FROM separation_cache WHERE fingerprint = ? AND stems_dir = ?",
+                            (fingerprint, stems_dir))
+
+    def add_separation(self, session: str, generation_id: int, timestamp: str, clips: int, cached_clips: int,
+                       processing_time: float):
+        self.writer.execute(self, "INSERT INTO separations VALUES (?, ?, ?, ?, ?, ?)", (
+            session, generation_id, timestamp, clips, cached_clips, processing_time
+        ))
+
+    def add_session_summary(self, session: str, timestamp: str, tracks_generated: int, tracks_separated: int,
+                            separation_usage_rate: float) -> float:
+        """
+        Stores a session summary and returns the separation usage rate averaged over all summaries.
+        """
+        with self.lock:
+            if self.aggregates is None:
+                rows = self._connect().execute("SELECT name, total, count FROM aggregates").fetchall()
+                self.aggregates = {name: [total, count] for name, total, count in rows}
+            aggregate = self.aggregates.setdefault("separation_usage_rate", [0.0, 0])
+            aggregate[0] += separation_usage_rate
+            aggregate[1] += 1
+            average = round(aggregate[0] / aggregate[1], 2)
+
+        self.writer.execute(self, "INSERT INTO session_summaries VALUES (?, ?, ?, ?, ?)", (
+            session, timestamp, tracks_generated, tracks_separated, separation_usage_rate
+        ))
+        self.writer.execute(self, (
+            "INSERT INTO aggregates VALUES ('separation_usage_rate', ?, 1) "
+            "ON CONFLICT(name) DO UPDATE SET total = total + excluded.total, count = count + 1"
+        ), (separation_usage_rate,))
+        return average
+
+    def export_csv(self, output_dir: str):
+        """
+        Writes every table to its own CSV file in output_dir.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        with self.lock:
+            connection = self._connect()
+            for table in ["generations", "separations", "session_summaries"]:
+                cursor = connection.execute(f"SELECT * FROM {table}")
+                with open(os.path.join(output_dir, f"{table}.csv"), mode="w", newline="") as file:
+                    writer = csv.writer(file)
+                    writer.writerow([column[0] for column in cursor.description])
+                    writer.writerows(cursor)
+
+
+session_store = SessionStore(os.path.join(BASE_DIR, "Sessions", "sessions.db"), metrics_writer)
 
 
 # Function to load musicgen model
 def load_model(model_name: str) -> MusicGen:
     full_model_name = f"facebook/musicgen-{model_name}"
     print(f"Loading model {full_model_name}...")
-    return MusicGen.get_pretrained(full_model_name)
+    model = MusicGen.get_pretrained(full_model_name, device=get_device())
+    if get_device() == "cpu":
+        model = accelerate_musicgen(model)
+    return model
+
+
+# Function to load demucs model
+def load_separation_model(model_name: str):
+    model = get_model(model_name)
+    model.eval()
+    if get_device() == "cpu":
+        model = accelerate_demucs(model)
+    return model
+
+
+# Memory taken by the weights of a musicgen model
+def model_size_bytes(model: MusicGen) -> int:
+    size = 0
+    for module in [model.lm, model.compression_model]:
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            size += tensor.numel() * tensor.element_size()
+    return size
+
+
+class ModelPool:
+    """
+    Process-wide registry of musicgen models keyed by variant ("small", "medium", "large").
+    Each variant is loaded lazily once and kept warm; least recently used variants are
+    evicted when the memory budget is exceeded.
+    """
+
+    def __init__(self, loader, memory_budget_gb: float):
+        self.loader = loader
+        self.memory_budget = int(memory_budget_gb * 1024 ** 3)
+        self.models = OrderedDict()  # model_name -> (model, size in bytes)
+        self.model_locks = {}  # model_name -> lock held while the model is in use
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.load_time = 0.0
+
+    def _model_lock(self, model_name: str) -> threading.Lock:
+        with self.lock:
+            return self.model_locks.setdefault(model_name, threading.Lock())
+
+    @contextmanager
+    def model(self, model_name: str):
+        """
+        Yields the model for the given variant. The model is reserved for the caller
+        (and cannot be evicted) until the block exits.
+        """
+        start_time = time.perf_counter()
+        with self._model_lock(model_name):
+            model = self._get(model_name)
+            # Includes the wait for other jobs using the same model, and the load on a miss
+            stage_metrics.observe("generation", "model_fetch", time.perf_counter() - start_time)
+            yield model
+
+    def _get(self, model_name: str) -> MusicGen:
+        with self.lock:
+            if model_name in self.models:
+                self.hits += 1
+                self.models.move_to_end(model_name)
+                return self.models[model_name][0]
+            self.misses += 1
+
+        # Load outside the pool lock so other variants stay available meanwhile
+        start_time = time.time()
+        model = self.loader(model_name)
+        elapsed_time = time.time() - start_time
+        size = model_size_bytes(model)
+
+        with self.lock:
+            self.load_time += elapsed_time
+            self.models[model_name] = (model, size)
+            self._evict(keep=model_name)
+        logging.info(f"Model '{model_name}' loaded in {elapsed_time:.2f} seconds ({size / 1024 ** 3:.2f} GB). {self.stats()}")
+        return model
+
+    def _evict(self, keep: str):
+        # Called with self.lock held
+        used = sum(size for _, size in self.models.values())
+        for name in list(self.models):
+            if used <= self.memory_budget:
+                break
+            if name == keep or self.model_locks[name].locked():
+                continue  # Never evict a model that is currently in use
+            _, size = self.models.pop(name)
+            used -= size
+            logging.info(f"Model '{name}' evicted from pool to free {size / 1024 ** 3:.2f} GB")
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def preload(self, model_names: List[str]):
+        for model_name in model_names:
+            with self.model(model_name):
+                pass
+
+    def stats(self) -> dict:
+        return {
+            "resident": list(self.models),
+            "hits": self.hits,
+            "misses": self.misses,
+            "load_time": round(self.load_time, 2),
+        }
+
+
+model_pool = ModelPool(load_model, MODEL_POOL_MEMORY_BUDGET_GB)
+
+
+class SamplingLock:
+    """
+    Guards the global RNG of torch, which MusicGen samples from. Unseeded generations sample
+    concurrently, a seeded one samples alone (on a fork of the RNG), so no concurrent generation
+    on another model variant consumes the random numbers of its seed.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.unseeded = 0  # Unseeded generations sampling now
+        self.seeded = False  # A seeded generation is sampling now
+        self.seeded_waiting = 0  # Seeded generations waiting, unseeded ones let them go first
+
+    @contextmanager
+    def sampling(self, seed: Optional[int], rng_state: Optional[dict] = None):
+        """
+        Samples with the RNG seeded with seed (if given). rng_state carries the RNG of one
+        generation across several blocks (the segments of a stream): it is restored on entry
+        and saved on exit.
+        """
+        with self.condition:
+            if seed is None:
+                self.condition.wait_for(lambda: not self.seeded and not self.seeded_waiting)
+                self.unseeded += 1
+            else:
+                self.seeded_waiting += 1
+                self.condition.wait_for(lambda: not self.seeded and not self.unseeded)
+                self.seeded_waiting -= 1
+                self.seeded = True
+        try:
+            if seed is None:
+                yield
+            else:
+                cuda = torch.cuda.is_available()
+                with torch.random.fork_rng(devices=[torch.cuda.current_device()] if cuda else []):
+                    if rng_state:
+                        torch.set_rng_state(rng_state["cpu"])
+                        if cuda:
+                            torch.cuda.set_rng_state(rng_state["cuda"])
+                    else:
+                        torch.manual_seed(seed)
+                    yield
+                    if rng_state is not None:
+                        rng_state["cpu"] = torch.get_rng_state()
+                        if cuda:
+                            rng_state["cuda"] = torch.cuda.get_rng_state()
+        finally:
+            with self.condition:
+                if seed is None:
+                    self.unseeded -= 1
+                else:
+                    self.seeded = False
+                self.condition.notify_all()
+
+
+sampling_lock = SamplingLock()
+
+
+class GenerationBatch:
+    def __init__(self):
+        self.requests = []  # (descriptions, future, submission time) of each request in the batch
+        self.full = threading.Event()
+
+
+class GenerationBatcher:
+    """
+    Gathers concurrent generation requests for the same (model, duration) and runs them
+    as a single model.generate call. The first request of a batch waits for the others
+    (up to window_s seconds or max_requests requests) and then runs the whole batch.
+    """
+
+    def __init__(self, pool: ModelPool, window_s: float, max_requests: int):
+        self.pool = pool
+        self.window_s = window_s
+        self.max_requests = max_requests
+        self.pending = {}  # (model_name, duration) -> batch still accepting requests
+        self.lock = threading.Lock()
+
+    def generate(self, model_name: str, duration: int, descriptions: List[str], seed: Optional[int] = None) -> tuple[torch.Tensor, int]:
+        """
+        Returns the generated waveforms for the given descriptions and their sample rate.
+        Seeded requests are never merged with others, their output only depends on their own seed.
+        """
+        if seed is not None:
+            future = Future()
+            self._run(model_name, duration, [(descriptions, future, time.perf_counter())], seed)
+            return future.result()
+
+        key = (model_name, duration)
+        future = Future()
+        with self.lock:
+            batch = self.pending.setdefault(key, GenerationBatch())
+            batch.requests.append((descriptions, future, time.perf_counter()))
+            is_leader = len(batch.requests) == 1
+            if len(batch.requests) >= self.max_requests:
+                del self.pending[key]
+                batch.full.set()
+
+        if is_leader:
+            batch.full.wait(self.window_s)
+            with self.lock:
+                if self.pending.get(key) is batch:
+                    del self.pending[key]  # Close the batch, later requests start a new one
+            self._run(model_name, duration, batch.requests)
+
+        return future.result()
+
+    def _run(self, model_name: str, duration: int, requests: list, seed: Optional[int] = None):
+        all_descriptions = [text for descriptions, _, _ in requests for text in descriptions]
+        run_start_time = time.perf_counter()
+        for _, _, submitted_at in requests:
+            stage_metrics.observe("generation", "batch_wait", run_start_time - submitted_at)
+        try:
+            with self.pool.model(model_name) as model:
+                model.set_generation_params(duration=duration, **GENERATION_PARAMS)
+                with sampling_lock.sampling(seed), stage_metrics.span("generation", "inference"):
+                    wavs = cpu_call("generation", model.generate, all_descriptions)
+                sample_rate = model.sample_rate
+        except Exception as e:
+            for _, future, _ in requests:
+                future.set_exception(e)
+            return
+
+        logging.info(f"Generation batch on model '{model_name}' ({duration}s): {len(requests)}/{self.max_requests} requests, {len(all_descriptions)} clips")
+
+        # Give each request back its own clips
+        offset = 0
+        for descriptions, future, _ in requests:
+            future.set_result((wavs[offset:offset + len(descriptions)], sample_rate))
+            offset += len(descriptions)
+
+
+generation_batcher = GenerationBatcher(model_pool, GENERATION_BATCH_WINDOW_S, GENERATION_MAX_BATCH_REQUESTS)
+
+
+# Streaming generation: yields the clips segment by segment, as soon as each one is decoded
+def generate_stream(pool: ModelPool, model_name: str, duration: int, descriptions: List[str],
+                    seed: Optional[int] = None, chunk_s: float = STREAMING_CHUNK_S,
+                    context_s: float = STREAMING_CONTEXT_S, crossfade_s: float = 0) -> Iterator[tuple[torch.Tensor, int]]:
+    """
+    Each segment continues from the last context_s seconds of the previous ones. With crossfade_s,
+    the end of each segment is held back and cross-faded with the same audio as decoded again by
+    the next continuation, which hides the seam between segments.
+    """
+    with pool.model(model_name) as model:
+        sample_rate = model.sample_rate
+    rng_state = {}  # RNG of this generation between segments, when seeded
+
+    context = None  # Tail of the audio generated so far
+    held = None  # End of the last segment, not yielded yet (cross-faded with the next one)
+    fade = int(crossfade_s * sample_rate)
+    generated = 0  # Samples generated so far
+    total = int(duration * sample_rate)
+    while generated < total:
+        segment_s = min(chunk_s, (total - generated) / sample_rate)
+        # Entered for each segment only: other requests can use the model while the consumer handles the segment
+        with pool.model(model_name) as model, sampling_lock.sampling(seed, rng_state), \
+                stage_metrics.span("generation", "inference"):
+            if context is None:
+                model.set_generation_params(duration=segment_s, **GENERATION_PARAMS)
+                segment = cpu_call("generation", model.generate, descriptions)
+                decoded_context = None
+            else:
+                # Continue from the tail of the previous segments, and keep only the new audio
+                model.set_generation_params(duration=context.shape[-1] / sample_rate + segment_s, **GENERATION_PARAMS)
+                output = cpu_call("generation", model.generate_continuation, context, sample_rate, descriptions)
+                decoded_context, segment = output[..., :context.shape[-1]], output[..., context.shape[-1]:]
+        if segment.shape[-1] == 0:
+            break
+        segment = segment[..., :total - generated]
+        generated += segment.shape[-1]
+        context = segment if context is None else torch.cat([context, segment], dim=-1)
+        context = context[..., -int(context_s * sample_rate):]
+        if fade:
+            if held is not None and decoded_context is not None:
+                overlap = min(held.shape[-1], decoded_context.shape[-1])
+                ramp = torch.linspace(0, 1, overlap, device=held.device)
+                blended = held[..., -overlap:] * (1 - ramp) + decoded_context[..., -overlap:] * ramp
+                segment = torch.cat([held[..., :held.shape[-1] - overlap], blended, segment], dim=-1)
+            held = segment[..., -fade:] if generated < total else None
+            segment = segment[..., :-fade] if held is not None else segment
+        yield segment, sample_rate
+    if held is not None:
+        yield held, sample_rate
+
+
+# Hardlinks a file into a new location (symlinks it if hardlinks are not supported) instead of copying it
+def link_file(source: str, destination: str):
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        os.symlink(os.path.abspath(source), destination)
+
+
+class GenerationCache:
+    """
+    On-disk content-addressed cache of generated clips. Each entry is a folder named after
+    the hash of (normalized description, model, duration, seed, generation mode and params);
+    the least recently used entries are removed when the size cap is exceeded.
+    """
+
+    def __init__(self, cache_dir: str, max_gb: float):
+        self.cache_dir = cache_dir
+        self.max_size = int(max_gb * 1024 ** 3)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(description: str, model_name: str, duration: int, seed: int, mode: str) -> str:
+        """
+        mode is how the clips are generated ("one_pass", "streamed" or "long_form"): the same
+        seed gives different audio when the clips are generated segment by segment.
+        """
+        content = {
+            "description": " ".join(description.split()),
+            "model": model_name,
+            "duration": duration,
+            "seed": seed,
+            "mode": mode,
+            "params": GENERATION_PARAMS,
+            "segments": {
+                "streamed": (STREAMING_CHUNK_S, STREAMING_CONTEXT_S),
+                "long_form": (LONG_FORM_WINDOW_S, LONG_FORM_CONTEXT_S, LONG_FORM_CROSSFADE_S),
+            }.get(mode),
+        }
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+    def lookup(self, key: str) -> Optional[List[str]]:
+        """
+        Returns the cached clips for the key, or None on a miss.
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        with self.lock:
+            if os.path.isdir(entry_dir):
+                self.hits += 1
+                os.utime(entry_dir)  # Mark as recently used
+                return sorted(os.path.join(entry_dir, name) for name in os.listdir(entry_dir))
+            self.misses += 1
+            return None
+
+    def store(self, key: str, file_paths: List[str]):
+        entry_dir = os.path.join(self.cache_dir, key)
+        tmp_dir = f"{entry_dir}.tmp{threading.get_ident()}"
+        os.makedirs(tmp_dir, exist_ok=True)
+        for idx, file_path in enumerate(file_paths):
+            link_file(str(file_path), os.path.join(tmp_dir, f"output_{idx}{os.path.splitext(file_path)[1]}"))
+        with self.lock:
+            if os.path.isdir(entry_dir):
+                shutil.rmtree(tmp_dir)  # Stored meanwhile by a concurrent request
+            else:
+                os.rename(tmp_dir, entry_dir)  # Entries appear complete or not at all
+            self._evict()
+
+    def _evict(self):
+        # Called with self.lock held
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            if os.path.isdir(entry_dir) and ".tmp" not in name:
+                size = sum(os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir))
+                entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+        used = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in sorted(entries):
+            if used <= self.max_size:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            used -= size
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups * 100, 2) if lookups else 0,
+        }
+
+
+generation_cache = GenerationCache(os.path.join(BASE_DIR, "Sessions", "cache", "generations"), GENERATION_CACHE_MAX_GB)
+
+
+# Shared by clip and stem writes
+encode_executor = ThreadPoolExecutor(max_workers=ENCODE_WORKERS, thread_name_prefix="audio-writer")
+
+
+def loudness_gain(wavs: torch.Tensor, sample_rate: int) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Gain bringing each clip of a batch (batch, channels, time) to -LOUDNESS_HEADROOM_DB LUFS,
+    and the loudness of the clips once the gain is applied.
+    """
+    energy = wavs.pow(2).mean(dim=(1, 2)).sqrt()
+    loudness = torchaudio.functional.loudness(wavs, sample_rate)
+    gain = 10.0 ** ((-LOUDNESS_HEADROOM_DB - loudness) / 20.0)
+    # Nearly silent clips are left untouched, as audiocraft does
+    quiet = energy < 2e-3
+    gain = torch.where(quiet, torch.ones_like(gain), gain)
+    loudness = torch.where(quiet, loudness, torch.full_like(loudness, -LOUDNESS_HEADROOM_DB))
+    return gain, loudness
+
+
+def normalize_loudness_batch(wavs: torch.Tensor, sample_rate: int) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Loudness normalization of a whole batch (batch, channels, time) with tensor ops, same
+    result as audio_write(..., strategy="loudness") applied clip by clip.
+    Returns the normalized clips and their loudness in LUFS.
+    """
+    gain, loudness = loudness_gain(wavs, sample_rate)
+    return (wavs * gain[:, None, None]).clamp_(-1, 1), loudness
+
+
+def to_pcm16(wav: torch.Tensor) -> torch.Tensor:
+    """
+    16 bit PCM samples (time, channels) of a clip (channels, time).
+    """
+    return (wav.clamp(-1, 1) * 32767).round().short().t().contiguous()
+
+
+# Long-form generation: clips longer than a single MusicGen pass, appended to WAV files window by window
+def generate_long_form(model_name: str, duration: int, descriptions: List[str], seed: Optional[int],
+                       paths: List[str]) -> Iterator[float]:
+    """
+    Generates the clips in windows of LONG_FORM_WINDOW_S seconds, each one continuing from the
+    last LONG_FORM_CONTEXT_S seconds and cross-faded with the previous one. Each window is
+    appended to the WAV files as soon as it is generated, so memory does not grow with the
+    duration. The gain bringing the first window to the target loudness is applied to the
+    whole clip. Yields the seconds written after each window.
+    """
+    wav_files = []
+    gain = None
+    written = 0
+    try:
+        for segment, sample_rate in workers.stream("generate_stream", model_name, duration, descriptions, seed,
+                                                   LONG_FORM_WINDOW_S, LONG_FORM_CONTEXT_S, LONG_FORM_CROSSFADE_S):
+            segment = segment.cpu()
+            if gain is None:
+                gain, _ = loudness_gain(segment, sample_rate)
+                for path in paths:
+                    wav_file = wave.open(path, "wb")
+                    wav_file.setnchannels(segment.shape[1])
+                    wav_file.setsampwidth(2)  # 16 bit PCM
+                    wav_file.setframerate(sample_rate)
+                    wav_files.append(wav_file)
+            with stage_metrics.span("generation", "disk_write"):
+                for wav_file, wav in zip(wav_files, segment * gain[:, None, None]):
+                    wav_file.writeframes(to_pcm16(wav).numpy().tobytes())
+            written += segment.shape[-1] / sample_rate
+            yield written
+    finally:
+        for wav_file in wav_files:
+            wav_file.close()  # Also writes the final length in the header
+
+
+class AudioBuffer:
+    """
+    A generated clip kept in memory: the (loudness normalized) waveform, shared by
+    separation and disk persistence, with its sample rate and loudness.
+    """
+
+    def __init__(self, path: str, wav: torch.Tensor, sample_rate: int, loudness_db: float):
+        self.path = path  # Where the clip is (or will be) written
+        self.wav = wav
+        self.sample_rate = sample_rate
+        self.loudness_db = loudness_db
+        self.written = Future()  # Completed once the clip is on disk
+
+
+class AudioBufferStore:
+    """
+    Keeps the most recent generated clips in memory and writes them to disk in the
+    background, so separation can start from the waveform before (and without) the file.
+    """
+
+    def __init__(self, max_clips: int, executor: ThreadPoolExecutor):
+        self.max_clips = max_clips
+        self.buffers = OrderedDict()  # (generation dir, clip index) -> AudioBuffer
+        self.lock = threading.Lock()
+        self.executor = executor
+
+    def put(self, generation_dir: str, clip_index: int, stem_name: str, wav: torch.Tensor, sample_rate: int,
+            loudness_db: float) -> AudioBuffer:
+        """
+        Stores an already normalized clip and schedules its write to {stem_name}.{AUDIO_FORMAT}.
+        """
+        buffer = AudioBuffer(f"{stem_name}.{AUDIO_FORMAT}", wav, sample_rate, loudness_db)
+        with self.lock:
+            key = (generation_dir, clip_index)
+            self.buffers[key] = buffer
+            self.buffers.move_to_end(key)
+            while len(self.buffers) > self.max_clips:
+                self.buffers.popitem(last=False)
+        self.executor.submit(self._write, buffer, stem_name)
+        return buffer
+
+    def _write(self, buffer: AudioBuffer, stem_name: str):
+        try:
+            with stage_metrics.span("generation", "disk_write"):
+                # Already normalized and clamped: "clip" at 0 dB leaves it unchanged ("peak" would still scale it down)
+                path = audio_write(stem_name, buffer.wav, buffer.sample_rate, format=AUDIO_FORMAT, normalize=False,
+                                   strategy="clip", peak_clip_headroom_db=0)
+            buffer.written.set_result(str(path))
+        except Exception as e:
+            logging.error(f"Writing {buffer.path} failed: {e}")
+            buffer.written.set_exception(e)
+
+    def find(self, file_audio_path: str, generation_dir: str, clip_index: int) -> Optional[AudioBuffer]:
+        """
+        Returns the buffer holding the given file, if any. Gradio serves a copy of the file,
+        so a different path is only accepted if file name and size match the written clip.
+        """
+        with self.lock:
+            buffer = self.buffers.get((generation_dir, clip_index))
+        if buffer is None:
+            return None
+        if os.path.abspath(file_audio_path) == os.path.abspath(buffer.path):
+            return buffer
+        if (buffer.written.done() and not buffer.written.exception()
+                and os.path.basename(file_audio_path) == os.path.basename(buffer.path)
+                and os.path.exists(file_audio_path)
+                and os.path.getsize(file_audio_path) == os.path.getsize(buffer.path)):
+            return buffer
+        return None
+
+
+audio_buffers = AudioBufferStore(MAX_IN_MEMORY_CLIPS, encode_executor)
 
 
 # Function to perform music generation
-def generate_music(description: str, duration: int, model_name: str) -> tuple[str, str, str, str]:
-    global generation_count, history, SESSIONS_BASE_DIR, CURRENT_SESSION_DIR, total_tracks_generated
+def generate_music(session: SessionState, description: str, duration: int, model_name: str, seed: Optional[int] = -1,
+                   stream: bool = False, auto_separate: bool = False, enqueued_at: Optional[float] = None) -> Iterator[tuple]:
+    """
+    Generates three clips from the description. Yields the outputs of the interface (three clips,
+    counter, the fifteen stems and the three live players): once at the end, and also after each
+    segment when streaming, with only the new audio of each clip for the live players.
+    Automatic separations are started here and shown by deliver_separations.
+    """
+    observe_queue_wait("generation", enqueued_at)
+    if session is None:
+        yield gr.update(), gr.update(), gr.update(), SESSION_NOT_READY, *[gr.update()] * 15, *NO_LIVE_AUDIO
+        return
+    session.start()
 
-    if CURRENT_SESSION_DIR is None:
-        setup_logging()
+    # Concurrent requests of the same session never share an id
+    generation_id = session.next_generation_id()
 
     # Ensure timestamp is defined at the start
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
 
     # Ensure CSV paths are defined
-    session_csv = os.path.join(CURRENT_SESSION_DIR, "session.csv")
+    session_csv = os.path.join(session.dir, "session.csv")
     global_csv = os.path.join(BASE_DIR, "Sessions", "all_sessions.csv")
 
-    # Increment generation count
-    generation_count += 1
-    logging.info(f"Generation #{generation_count} started. Description: '{description}', Duration: {duration}s, Model: '{model_name}'")
+    # A non-negative seed makes the generation deterministic, and therefore cacheable
+    seed = int(seed) if seed is not None and seed >= 0 else None
+
+    session.log.info(f"Generation #{generation_id} started. Description: '{description}', Duration: {duration}s, Model: '{model_name}', Seed: {seed}")
     
     start_time = time.time()  # Start measuring time
 
     # Create folder for this generation
-    generation_dir = os.path.join(CURRENT_SESSION_DIR, f"generation_{generation_count}")
+    generation_dir = os.path.join(session.dir, f"generation_{generation_id}")
     os.makedirs(generation_dir, exist_ok=True)
+    storage_manager.touch(generation_dir)
 
-    try:
-        # Load the model safely
-        model = load_model(model_name)
-        model.set_generation_params(duration=duration)
+    time_to_first_audio = None  # Time until the interface receives some audio
 
-        descriptions = [description] * 3
-        wavs = model.generate(descriptions)
-
-        # Ensure `wavs` is valid
-        if isinstance(wavs, torch.Tensor) and wavs.numel() == 0:
-            raise ValueError("Model output is empty")
+    # Stems are cleared when this generation separates its clips, untouched otherwise
+    stem_outputs = [None] * 15 if auto_separate else [gr.update()] * 15
+    separation_future = None  # Separation of all the clips of this generation, in one batch
 
+    try:
+        mode = "long_form" if duration > MAX_WINDOW_S else "streamed" if stream else "one_pass"
+        cache_key = generation_cache.key(description, model_name, duration, seed, mode) if seed is not None else None
+        cached_paths = generation_cache.lookup(cache_key) if cache_key else None
 
         file_paths = []
-        for idx, wav in enumerate(wavs):
-            file_path = audio_write(
-                os.path.join(generation_dir, f"output_{idx}_{os.path.basename(CURRENT_SESSION_DIR)}"),
-                wav.cpu(),
-                model.sample_rate,
-                strategy="loudness"
-            )
-            file_paths.append(file_path)
-            print(f" Saved file: {file_path}")  # 🔍 Debugging print
+        if cached_paths:
+            # Same request already generated: link the stored clips into this generation
+            for idx, cached_path in enumerate(cached_paths):
+                file_path = Path(generation_dir, f"output_{idx}_{session.name}{os.path.splitext(cached_path)[1]}")
+                link_file(cached_path, str(file_path))
+                file_paths.append(file_path)
+            if auto_separate:
+                separation_future = submit_separation(session, [str(path) for path in file_paths], generation_id)
+            session.log.info(f"Generation #{generation_id} served from cache. Cache stats: {generation_cache.stats()}")
+        else:
+            descriptions = [description] * 3
+            if duration > MAX_WINDOW_S:
+                # Long-form: generated window by window and written to disk as it goes, never whole in memory
+                paths = [os.path.join(generation_dir, f"output_{idx}_{session.name}.wav") for idx in range(3)]
+                windows = -(-duration // LONG_FORM_WINDOW_S)
+                for window, written_s in enumerate(generate_long_form(model_name, duration, descriptions, seed, paths), 1):
+                    yield (
+                        gr.update(), gr.update(), gr.update(),
+                        f"Generating... window {min(window, windows)}/{windows} ({written_s:.0f}/{duration} s)",
+                        *stem_outputs, *NO_LIVE_AUDIO
+                    )
+                file_paths = [Path(path) for path in paths]
+                session.log.info(f"Generation #{generation_id}: {duration} seconds generated in {windows} windows in {time.time() - start_time:.2f} seconds")
+                if auto_separate:
+                    separation_future = submit_separation(session, paths, generation_id)
+            else:
+                if stream:
+                    # Send only the new audio of each segment: the live players append it and keep playing
+                    segments = []
+                    gain = None
+                    generated = 0
+                    for segment, sample_rate in workers.stream("generate_stream", model_name, duration, descriptions, seed):
+                        segment = segment.cpu()
+                        segments.append(segment)
+                        generated += segment.shape[-1]
+                        if gain is None:
+                            gain, _ = loudness_gain(segment, sample_rate)  # The whole clip is normalized once it is complete
+                        if time_to_first_audio is None:
+                            time_to_first_audio = round(time.time() - start_time, 2)
+                        yield (
+                            gr.update(), gr.update(), gr.update(),
+                            f"Generating... {generated / sample_rate:.0f}/{duration} s",
+                            *stem_outputs,
+                            *[(sample_rate, to_pcm16(wav).numpy()) for wav in segment * gain[:, None, None]]
+                        )
+                    wavs = torch.cat(segments, dim=-1) if segments else None
+                    del segments
+                else:
+                    # Generate together with other pending requests for the same model and duration (on the least loaded worker)
+                    wavs, sample_rate = workers.call("generate", model_name, duration, descriptions, seed)
+
+                # Ensure `wavs` is valid
+                if wavs is None or isinstance(wavs, torch.Tensor) and wavs.numel() == 0:
+                    raise ValueError("Model output is empty")
+                model_time = round(time.time() - start_time, 2)
+                postprocess_start_time = time.time()
+
+                # A single copy of the clips on CPU, shared by separation and disk persistence.
+                # Normalized here (instead of inside audio_write) for the whole batch at once, so the
+                # separation engine can reuse the exact waveforms that are written to disk
+                with stage_metrics.span("generation", "encoding"):
+                    wavs, loudness = normalize_loudness_batch(wavs.cpu(), sample_rate)
+                buffers = []
+                for idx, wav in enumerate(wavs):
+                    buffer = audio_buffers.put(
+                        generation_dir, idx,
+                        os.path.join(generation_dir, f"output_{idx}_{session.name}"),
+                        wav,
+                        sample_rate,
+                        float(loudness[idx])
+                    )
+                    buffers.append(buffer)
+                if auto_separate:
+                    # Separation of the clips starts from memory, while they are written to disk (and the next generation runs)
+                    separation_future = submit_separation(session, [buffer.path for buffer in buffers], generation_id)
+                del wavs
+
+                # The interface plays the clips from disk, wait for the background writes
+                for buffer in buffers:
+                    file_path = Path(buffer.written.result())
+                    file_paths.append(file_path)
+                    print(f" Saved file: {file_path}")  # 🔍 Debugging print
+                postprocess_time = round(time.time() - postprocess_start_time, 2)
+                session.log.info(f"Generation #{generation_id}: model time {model_time} seconds, post-processing (normalization and encoding) {postprocess_time} seconds")
+
+            if cache_key:
+                generation_cache.store(cache_key, file_paths)
+                session.log.info(f"Generation #{generation_id} stored in cache. Cache stats: {generation_cache.stats()}")
 
         for file in file_paths:
             if os.path.isdir(file):
                 print(f" ERROR: {file} is a directory, not a file!")
         end_time = time.time()
         elapsed_time = round(end_time - start_time, 2)
+        if time_to_first_audio is None:
+            time_to_first_audio = elapsed_time  # Not streamed, the audio arrives with the complete clips
 
-        logging.info(f"Generation #{generation_count} completed in {elapsed_time} seconds. Generated files: {file_paths}")
+        stage_metrics.observe("generation", "total", elapsed_time)
+        record_startup("first_ready_generation")  # Without warm-up, the first generation marks it
+        stage_metrics.observe("generation", "time_to_first_audio", time_to_first_audio)
+        session.log.info(f"Generation #{generation_id} completed in {elapsed_time} seconds (first audio after {time_to_first_audio} seconds). Generated files: {file_paths}")
 
-        # Write to CSV safely
         try:
-            with open(session_csv, mode="a", newline="") as file:
-                writer = csv.writer(file)
-                writer.writerow([generation_count, timestamp, description, duration, model_name, elapsed_time, str(file_paths)])
+            session_store.add_generation(session.name, generation_id, timestamp, description,
+                                         duration, model_name, elapsed_time, time_to_first_audio, file_paths)
         except Exception as e:
-            print(f" Error writing to CSV {session_csv}: {e}")
+            print(f" Error writing generation to the session store: {e}")
 
-        try:
-            with open(global_csv, mode="a", newline="") as file:
-                writer = csv.writer(file)
-                writer.writerow([generation_count, timestamp, description, duration, model_name, elapsed_time, str(file_paths)])
-        except Exception as e:
-            print(f" Error writing to CSV {global_csv}: {e}")
-
-        # Update history
-        history.append({
-            "id": generation_count,
-            "files": file_paths,
-            "description": description,
-        })
+        # Write to CSV (in the background, errors are reported by the metrics writer)
+        for csv_file in [session_csv, global_csv]:
+            metrics_writer.write_csv(csv_file, [generation_id, timestamp, description, duration, model_name, elapsed_time, str(file_paths), time_to_first_audio])
 
         # Track the number of generated tracks
-        total_tracks_generated += len(file_paths)
+        session.count_tracks(generated=len(file_paths))
 
         # Avoid index errors when returning
         while len(file_paths) < 3:
@@ -223,110 +1573,863 @@ def generate_music(description: str, duration: int, model_name: str) -> tuple[st
                 print(f" ERROR: {file_paths[0]} is a directory!")
 
 
-        return (
+        outputs = (
             file_paths[0] if os.path.exists(file_paths[0]) else "",  
             file_paths[1] if os.path.exists(file_paths[1]) else "",  
             file_paths[2] if os.path.exists(file_paths[2]) else "",  
-            f"{texts[current_language]['counter_label']} {generation_count}"
+            f"{texts[current_language]['counter_label']} {generation_id}"
         )
+        if separation_future is not None:
+            # Shown by deliver_separations, so this event (and its generation slot) ends with the clips
+            with session.lock:
+                session.pending_separations[generation_id] = (separation_future, start_time)
+        session.displayed_generation_id = generation_id  # The separation buttons now work on these clips
+        yield (*outputs, *stem_outputs, *NO_LIVE_AUDIO)
 
     except Exception as e:
-        logging.error(f"Generation failed: {e}")
+        session.log.error(f"Generation failed: {e}")
         print(f" Error: {e}")
-        return "", "", "", f"Error: {e}"
+        yield "", "", "", f"Error: {e}", *stem_outputs, *NO_LIVE_AUDIO
+
+# Stems of the automatic separations, run as its own event after the generation
+def deliver_separations(session: Optional[SessionState]) -> Iterator[tuple]:
+    """
+    Shows the stems of the clips of the displayed generation once their automatic separation (one batch) is done.
+    """
+    yield (gr.update(),) * 15
+    if session is None:
+        return
+    with session.lock:
+        generation_id = session.displayed_generation_id
+        pending = session.pending_separations.pop(generation_id, None)
+        # Separations of generations that are not shown anymore still finish, they are just not displayed
+        for older_id in [gen_id for gen_id in session.pending_separations if gen_id < generation_id]:
+            del session.pending_separations[older_id]
+    if pending is None:
+        return
+    separation_future, start_time = pending
+    try:
+        results = separation_future.result()
+    except Exception as e:
+        session.log.error(f"Automatic separation of generation #{generation_id} failed: {e}")
+        return
+    stem_outputs = [stem for stems in results for stem in stems]
+    yield tuple(stem_outputs + [None] * (15 - len(stem_outputs)))
+    session.count_tracks(separated=len(results))
+    session.log.info(f"Generation #{generation_id}: {len(results)} clips separated automatically in {time.time() - start_time:.2f} seconds from the start of the generation")
+
+# History update function: a page of the generations matching the search, newest first
+# (the samples of a gr.Dataset are only replaced by returning a new gr.Dataset, not by a list of values)
+def history_update(query: str, page: int, step: int = 0) -> tuple[gr.Dataset, int, str]:
+    page = max(int(page or 1) + step, 1)
+    try:
+        rows, total = session_store.history_page(query or "", page - 1, HISTORY_PAGE_SIZE)
+        pages = max((total + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE, 1)
+        if page > pages:
+            page = pages
+            rows, total = session_store.history_page(query or "", page - 1, HISTORY_PAGE_SIZE)
+    except Exception as e:
+        print(f" Error reading the history: {e}")
+        return gr.Dataset(samples=[["-1", "", "", "History not available"]]), page, ""
+    if not rows:
+        return gr.Dataset(samples=[["-1", "", "", "No generated item available"]]), 1, ""
+    samples = [[str(history_id), session, timestamp, description] for history_id, session, timestamp, description in rows]
+    return gr.Dataset(samples=samples), page, f"{total} generations, page {page} of {pages}"
+
+# File loading function from history, the audio is only read when a generation is opened
+def load_from_history(id_generation: int) -> tuple[Optional[str], Optional[str], Optional[str]]:
+    files = []
+    for file in session_store.history_files(int(id_generation or -1)):
+        if not os.path.exists(file):
+            file = f"{os.path.splitext(file)[0]}.flac"  # Transcoded by the storage manager
+        if os.path.exists(file):
+            files.append(file)
+            storage_manager.touch(os.path.dirname(file))
+    files += [None] * (3 - len(files))
+    return tuple(files[:3])  # Returns files from selected generation (None if no file found)
+
+# Opens the generation of a row clicked in the history list
+def load_history_row(row: List[str]) -> tuple:
+    history_id = int(row[0]) if row and str(row[0]).lstrip("-").isdigit() else -1
+    return (*load_from_history(history_id), history_id)
+
+class SeparationEngine:
+    """
+    Keeps the demucs model loaded in the server process and separates waveforms directly,
+    instead of starting a new `python -m demucs.separate` interpreter for every clip.
+    """
+
+    def __init__(self, model_name: str, loader=load_separation_model):
+        self.model_name = model_name
+        self.loader = loader
+        self.model = None
+        self.lock = threading.Lock()
+
+    def get_model(self):
+        with self.lock, stage_metrics.span("separation", "model_fetch"):
+            if self.model is None:
+                start_time = time.time()
+                self.model = self.loader(self.model_name)
+                logging.info(f"Separation model '{self.model_name}' loaded in {time.time() - start_time:.2f} seconds")
+            return self.model
+
+    @staticmethod
+    def read_clip(file_audio_path: str, generation_dir: str, clip_index: int) -> tuple[torch.Tensor, int]:
+        """
+        Returns the waveform of a clip and its sample rate, from the audio buffers when possible.
+        """
+        buffer = audio_buffers.find(file_audio_path, generation_dir, clip_index)
+        if buffer is not None:
+            return buffer.wav, buffer.sample_rate
+        return torchaudio.load(file_audio_path)
+
+    def separate_clips(self, clips: List[tuple[torch.Tensor, int]]) -> tuple[List[Dict[str, torch.Tensor]], int]:
+        """
+        Separates clips given as (waveform, sample rate), returns their sources and the sample rate of the sources.
+        """
+        model = self.get_model()
+        wavs = [convert_audio(wav, sample_rate, model.samplerate, model.audio_channels) for wav, sample_rate in clips]
+        return self.separate_batch(wavs), model.samplerate
+
+    def separate_batch(self, wavs: List[torch.Tensor]) -> List[Dict[str, torch.Tensor]]:
+        """
+        Separates several waveforms (channels, time) with a single model invocation.
+        The model is applied to overlapping chunks that are cross-faded back together
+        (overlap-add), so peak memory depends on the chunk size and not on the clip length.
+        """
+        model = self.get_model()
+
+        # Each clip is normalized on its own, as demucs.separate does
+        refs = [wav.mean(0) for wav in wavs]
+        means = [ref.mean() for ref in refs]
+        stds = [ref.std() for ref in refs]
+        lengths = [wav.shape[-1] for wav in wavs]
+
+        # Clips from the same generation have the same length, pad just in case
+        batch = torch.zeros(len(wavs), model.audio_channels, max(lengths))
+        for idx, wav in enumerate(wavs):
+            batch[idx, :, :lengths[idx]] = (wav - means[idx]) / stds[idx]
+
+        def run() -> torch.Tensor:
+            # Autocast is set per thread, it is entered on the thread that runs the model
+            with torch.autocast("cpu", dtype=torch.bfloat16, enabled=get_device() == "cpu" and CPU_PRECISION == "bf16"):
+                return apply_model(model, batch, device=get_device(), shifts=1, split=True,
+                                   overlap=SEPARATION_OVERLAP, num_workers=SEPARATION_NUM_WORKERS).float()
+
+        with stage_metrics.span("separation", "engine"):
+            sources = cpu_call("separation", run)
+
+        results = []
+        for idx in range(len(wavs)):
+            clip_sources = sources[idx, ..., :lengths[idx]] * stds[idx] + means[idx]
+            results.append(dict(zip(model.sources, clip_sources)))
+        return results
+
+    def save_stems(self, stems: Dict[str, torch.Tensor], output_dir: str, samplerate: int) -> List[Future]:
+        """
+        Schedules the writes of the stems on the encoding threads, returns their futures.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        return [
+            encode_executor.submit(self._save_stem, source, os.path.join(output_dir, f"{name}.{STEMS_FORMAT}"), samplerate)
+            for name, source in stems.items()
+        ]
+
+    @staticmethod
+    def _save_stem(source: torch.Tensor, path: str, samplerate: int):
+        if STEMS_FORMAT == "flac":
+            # Not handled by demucs.audio.save_audio
+            torchaudio.save(path, prevent_clip(source, mode="rescale"), samplerate,
+                            format="flac", bits_per_sample=16)
+        else:
+            save_audio(source, path, samplerate=samplerate, clip="rescale", bits_per_sample=16, as_float=False)
+
+
+separation_engine = SeparationEngine(SEPARATION_MODEL)
+
 
-def create_session_folder():
-    global CURRENT_SESSION_DIR
-    now = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    CURRENT_SESSION_DIR = os.path.join(BASE_DIR, f"session_{now}")
-    os.makedirs(CURRENT_SESSION_DIR, exist_ok=True)
-    print(f"Session folder created: {CURRENT_SESSION_DIR}")
+# Jobs run by a worker: the parts of generation and separation that need the models
+def run_job(kind: str, *args):
+    if kind == "generate":
+        wavs, sample_rate = generation_batcher.generate(*args)
+        return wavs.cpu().clone(), sample_rate  # Its own copy, not a view of the whole batch
+    if kind == "generate_stream":
+        return ((segment.cpu(), sample_rate) for segment, sample_rate in generate_stream(model_pool, *args))
+    if kind == "separate":
+        return separation_engine.separate_clips(*args)
+    if kind == "ping":
+        return {"models": model_pool.stats()}
+    raise ValueError(f"Unknown job: {kind}")
 
-# History update function
-def history_update() -> List[List[str]]:
-    if not history:
-        return [["-1", "No generated item available"]]
-    return [[str(item["id"]), item["description"]] for item in history]
 
-def separate_all_wrapper(clip1, clip2, clip3):
+STREAM_JOBS = {"generate_stream"}  # Jobs whose result is sent item by item
+
+
+class WorkerUnavailable(Exception):
     """
-    Wrapper to call separate_all_clips with the current value of generation_count.
+    The worker could not be reached, the job can be sent to another one.
     """
-    return separate_all_clips(clip1, clip2, clip3, generation_count)
 
-# File loading function from history
-def load_from_history(id_generation: int) -> tuple[Optional[str], Optional[str], Optional[str]]:
-    for item in history:
-        if item["id"] == id_generation:
-            return tuple(item["files"])  # Returns files from selected generation
-    return None, None, None  # No file found
-
-# Utility function to copy process streams
-def copy_process_streams(process: sp.Popen):
-    def raw(stream: Optional[io.BufferedIOBase]) -> io.BufferedIOBase:
-        assert stream is not None
-        if isinstance(stream, io.BufferedIOBase):
-            stream = stream.raw
-        return stream
-
-    p_stdout, p_stderr = raw(process.stdout), raw(process.stderr)
-    stream_by_fd = {
-        p_stdout.fileno(): (p_stdout, sys.stdout),
-        p_stderr.fileno(): (p_stderr, sys.stderr),
-    }
-    fds = list(stream_by_fd.keys())
-
-    while fds:
-        ready, _, _ = select.select(fds, [], [])
-        for fd in ready:
-            p_stream, std = stream_by_fd[fd]
-            raw_buf = p_stream.read(2 ** 16)
-            if not raw_buf:
-                fds.remove(fd)
+
+class LoopbackWorker:
+    """
+    Runs the jobs in this process (the default, no worker needs to be started).
+    """
+
+    address = "loopback"
+
+    def call(self, kind: str, *args):
+        return run_job(kind, *args)
+
+    def stream(self, kind: str, *args) -> Iterator:
+        yield from run_job(kind, *args)
+
+
+class RemoteWorker:
+    """
+    Runs the jobs on a worker process started with --worker host:port, one connection per job.
+    Arguments and results are pickled; the connection is authenticated with WORKER_AUTHKEY.
+    """
+
+    def __init__(self, address: str, authkey: bytes):
+        self.address = address
+        host, port = address.rsplit(":", 1)
+        self.endpoint = (host, int(port))
+        self.authkey = authkey
+
+    def _messages(self, kind: str, args: tuple) -> Iterator[tuple]:
+        try:
+            connection = Client(self.endpoint, authkey=self.authkey)
+        except (OSError, EOFError, AuthenticationError) as e:
+            raise WorkerUnavailable(f"Worker {self.address}: {e}") from e
+        with connection:
+            try:
+                connection.send((kind, args))
+            except (OSError, EOFError) as e:
+                raise WorkerUnavailable(f"Worker {self.address}: {e}") from e
+            while True:
+                try:
+                    status, value = connection.recv()
+                except (OSError, EOFError) as e:
+                    raise WorkerUnavailable(f"Worker {self.address}: {e}") from e
+                if status == "error":
+                    raise RuntimeError(f"Worker {self.address}: {value}")
+                yield status, value
+                if status == "done":
+                    return
+
+    def call(self, kind: str, *args):
+        for status, value in self._messages(kind, args):
+            if status == "done":
+                return value
+
+    def stream(self, kind: str, *args) -> Iterator:
+        for status, value in self._messages(kind, args):
+            if status == "item":
+                yield value
+
+
+class WorkerPool:
+    """
+    Dispatches generation and separation jobs to the least loaded healthy worker. Remote
+    workers are pinged every health_interval_s seconds; a worker that cannot be reached is
+    skipped until it answers a ping again, and its job is sent to another worker.
+    """
+
+    def __init__(self, pool_workers: list, health_interval_s: float):
+        self.workers = pool_workers
+        self.health_interval_s = health_interval_s
+        self.active = {worker.address: 0 for worker in pool_workers}  # Jobs running on each worker
+        self.healthy = {worker.address: True for worker in pool_workers}
+        self.lock = threading.Lock()
+        self.health_thread = None
+
+    def start(self):
+        with self.lock:
+            if self.health_thread is None and any(isinstance(worker, RemoteWorker) for worker in self.workers):
+                self.health_thread = threading.Thread(target=self._check_health, name="worker-health", daemon=True)
+                self.health_thread.start()
+
+    def _acquire(self, excluded: set):
+        with self.lock:
+            candidates = [worker for worker in self.workers
+                          if self.healthy[worker.address] and worker.address not in excluded]
+            if not candidates:
+                raise RuntimeError("No worker available")
+            worker = min(candidates, key=lambda worker: self.active[worker.address])
+            self.active[worker.address] += 1
+            return worker
+
+    def _release(self, worker):
+        with self.lock:
+            self.active[worker.address] -= 1
+
+    def _set_health(self, worker, healthy: bool, reason: str = ""):
+        with self.lock:
+            changed = self.healthy[worker.address] != healthy
+            self.healthy[worker.address] = healthy
+        if changed:
+            if healthy:
+                logging.info(f"Worker {worker.address} is available again")
+            else:
+                logging.warning(f"Worker {worker.address} unavailable: {reason}")
+
+    def call(self, kind: str, *args):
+        """
+        Runs a job on the least loaded worker, on the next one if it cannot be reached.
+        """
+        self.start()
+        tried = set()
+        while True:
+            worker = self._acquire(tried)
+            try:
+                return worker.call(kind, *args)
+            except WorkerUnavailable as e:
+                self._set_health(worker, False, str(e))
+                tried.add(worker.address)
+            finally:
+                self._release(worker)
+
+    def stream(self, kind: str, *args) -> Iterator:
+        """
+        Runs a job producing several results on the least loaded worker (not retried once started).
+        """
+        self.start()
+        worker = self._acquire(set())
+        try:
+            yield from worker.stream(kind, *args)
+        except WorkerUnavailable as e:
+            self._set_health(worker, False, str(e))
+            raise
+        finally:
+            self._release(worker)
+
+    def _check_health(self):
+        while True:
+            for worker in self.workers:
+                try:
+                    worker.call("ping")
+                    self._set_health(worker, True)
+                except Exception as e:
+                    self._set_health(worker, False, str(e))
+            time.sleep(self.health_interval_s)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {address: {"active": self.active[address], "healthy": self.healthy[address]} for address in self.active}
+
+
+# Key authenticating the connections between front end and workers. Jobs are unpickled by the
+# worker, so there is no default: a key known to others would let them run code on the worker
+def worker_authkey() -> bytes:
+    if not WORKER_AUTHKEY:
+        raise RuntimeError("MUSIC_WORKER_AUTHKEY must be set to a secret shared by the front end and the workers")
+    return WORKER_AUTHKEY.encode()
+
+
+# Builds the pool of the given worker addresses, or of the in-process worker when there are none
+def create_worker_pool(addresses: List[str]) -> WorkerPool:
+    pool_workers = [RemoteWorker(address, worker_authkey()) for address in addresses] or [LoopbackWorker()]
+    return WorkerPool(pool_workers, WORKER_HEALTH_INTERVAL_S)
+
+
+workers = create_worker_pool(WORKERS)
+
+
+# Answers the job sent on one connection by a front end
+def handle_worker_connection(connection):
+    with connection:
+        try:
+            kind, args = connection.recv()
+            if kind in STREAM_JOBS:
+                for item in run_job(kind, *args):
+                    connection.send(("item", item))
+                connection.send(("done", None))
+            else:
+                connection.send(("done", run_job(kind, *args)))
+        except (OSError, EOFError):
+            pass  # The front end went away
+        except Exception as e:
+            logging.error(f"Worker job failed: {e}")
+            try:
+                connection.send(("error", f"{type(e).__name__}: {e}"))
+            except (OSError, EOFError):
+                pass
+
+
+# Worker mode: serves the generation and separation jobs of front ends on host:port
+def serve_worker(address: str):
+    host, port = address.rsplit(":", 1)
+    with Listener((host, int(port)), authkey=worker_authkey()) as listener:
+        print(f"Worker listening on {address}")
+        while True:
+            try:
+                connection = listener.accept()
+            except (OSError, EOFError, AuthenticationError) as e:
+                logging.warning(f"Worker connection rejected: {e}")
                 continue
-            buf = raw_buf.decode()
-            std.write(buf)
-            std.flush()
+            threading.Thread(target=handle_worker_connection, args=(connection,), daemon=True).start()
+
+# Threads separating clips automatically right after they are generated (they wait for separation_slots)
+separation_executor = ThreadPoolExecutor(max_workers=SEPARATION_CONCURRENCY, thread_name_prefix="separation")
+# Separations running at once, automatic ones and those of the separation buttons together
+separation_slots = threading.BoundedSemaphore(SEPARATION_CONCURRENCY)
+
+
+# Schedules the separation of the clips of a generation, in one batch, on the separation threads
+def submit_separation(session: SessionState, file_audio_paths: List[str], generation_id: int) -> Future:
+    submitted_at = time.perf_counter()
+
+    def run():
+        stage_metrics.observe("separation", "executor_wait", time.perf_counter() - submitted_at)
+        return separate_tracks_batch(session, file_audio_paths, generation_id, list(range(len(file_audio_paths))))
+
+    return separation_executor.submit(run)
+
+
+# Paths of the stems in a demucs output directory (None for missing files)
+def stem_paths(output_dir: str) -> List[Optional[str]]:
+    final_paths = []
+    for stem in SEPARATION_STEMS:
+        path = os.path.join(output_dir, f"{stem}.{STEMS_FORMAT}")
+        if not os.path.exists(path):
+            path = os.path.join(output_dir, f"{stem}.flac")  # Transcoded by the storage manager
+        final_paths.append(path)
+    return [path if os.path.exists(path) else None for path in final_paths]
+
+
+class SeparationCache:
+    """
+    Remembers where the stems of already separated audio are stored, indexed by a
+    fingerprint of the audio content and the separation model. The index is a table of the
+    session store, so it survives restarts; new entries are written by the metrics writer
+    and can be looked up within METRICS_FLUSH_INTERVAL_S.
+    """
+
+    def __init__(self, store: SessionStore, model_name: str, legacy_index_path: str):
+        self.session_store = store
+        self.model_name = model_name
+        self.legacy_index_path = legacy_index_path  # JSON index of older versions, moved into the store
+        self.lock = threading.Lock()
+        self.migrated = False
+        self.hits = 0
+        self.misses = 0
+
+    def fingerprint(self, file_audio_path: str) -> str:
+        digest = hashlib.sha256(self.model_name.encode())
+        with open(file_audio_path, "rb") as file:
+            for chunk in iter(lambda: file.read(2 ** 20), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _migrate(self):
+        # Called with self.lock held
+        if self.migrated:
+            return
+        self.migrated = True
+        if not os.path.exists(self.legacy_index_path):
+            return
+        try:
+            with open(self.legacy_index_path) as file:
+                index = json.load(file)
+            self.session_store.execute_many(SessionStore.STORE_STEMS, list(index.items()))  # Right away, before the first lookup
+            os.replace(self.legacy_index_path, f"{self.legacy_index_path}.migrated")
+        except Exception as e:
+            print(f" Warning: Could not import {self.legacy_index_path}: {e}")
+
+    def restore(self, fingerprint: str, output_dir: str) -> bool:
+        """
+        Makes the stems of the fingerprinted audio available in output_dir.
+        Returns False if the audio was never separated (or its stems were deleted).
+        """
+        with self.lock:
+            self._migrate()
+        cached_dir = self.session_store.cached_stems(fingerprint)
+        if cached_dir is None or None in stem_paths(cached_dir):
+            if cached_dir is not None:
+                self.session_store.forget_stems(fingerprint, cached_dir)  # Stems deleted, e.g. by the storage manager
+            with self.lock:
+                self.misses += 1
+            return False
+        with self.lock:
+            self.hits += 1
+
+        if os.path.abspath(cached_dir) != os.path.abspath(output_dir):
+            os.makedirs(output_dir, exist_ok=True)
+            for path in stem_paths(cached_dir):
+                link_file(path, os.path.join(output_dir, os.path.basename(path)))
+        return True
+
+    def store(self, fingerprint: str, output_dir: str):
+        self.session_store.store_stems(fingerprint, output_dir)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+separation_cache = SeparationCache(session_store, SEPARATION_MODEL,
+                                   os.path.join(BASE_DIR, "Sessions", "cache", "separations.json"))
+
+
+class StorageManager:
+    """
+    Background thread keeping the Sessions/ tree within its quotas. Each pass:
+    deduplicates identical audio files (content hash) into hardlinks, transcodes cold WAV
+    files to FLAC, deletes clips and stems older than the max age, then deletes the least
+    recently used ones (stems first, they can be separated again) while a session or the
+    whole tree is over its quota. Files of the generations shown in an open browser session,
+    or used recently, are left alone. Files shared with the caches through hardlinks are
+    only counted once.
+    """
+
+    AUDIO_EXTENSIONS = (".wav", ".flac", ".mp3", ".ogg")
+
+    def __init__(self, sessions_dir: str, global_quota_gb: float, session_quota_gb: float,
+                 max_age_days: Optional[float], cold_after_h: Optional[float], protect_h: float):
+        self.sessions_dir = sessions_dir
+        self.global_quota = int(global_quota_gb * 1024 ** 3)
+        self.session_quota = int(session_quota_gb * 1024 ** 3)
+        self.max_age_s = max_age_days * 86400 if max_age_days is not None else None
+        self.cold_after_s = cold_after_h * 3600 if cold_after_h is not None else None
+        self.protect_s = protect_h * 3600
+        self.last_used = {}  # Generation directory -> last time it was used
+        self.hashes = {}  # (path, size, mtime) -> content hash, so unchanged files are hashed once
+        self.lock = threading.Lock()  # Protects last_used and the thread
+        self.thread = None
+        self.totals = {"deduplicated": 0, "transcoded": 0, "evicted_age": 0, "evicted_quota": 0}
+        self.last_report = None
+
+    def touch(self, generation_dir: str):
+        """
+        Marks the files of a generation as used now.
+        """
+        with self.lock:
+            self.last_used[os.path.abspath(generation_dir)] = time.time()
+
+    def start(self, interval_s: float):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, args=(interval_s,), name="storage-manager", daemon=True)
+                self.thread.start()
+
+    def _run(self, interval_s: float):
+        while True:
+            time.sleep(interval_s)
+            try:
+                self.run_once()
+            except Exception as e:
+                logging.error(f"Storage manager pass failed: {e}")
+
+    def _scan(self) -> tuple[list, dict, dict]:
+        """
+        Returns the audio files of the generations (dicts with their path, session, kind, size,
+        inode and last use), the size of every file of the tree by inode and the link count of
+        those inodes (links outside the tree, such as the caches, included).
+        """
+        files = []
+        inodes = {}
+        links = {}
+        for root, _, names in os.walk(self.sessions_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.lstat(path)
+                except OSError:
+                    continue  # Removed meanwhile
+                inodes[(stat.st_dev, stat.st_ino)] = stat.st_size
+                links[(stat.st_dev, stat.st_ino)] = stat.st_nlink
+                parts = os.path.relpath(path, self.sessions_dir).split(os.sep)
+                if (len(parts) < 3 or not parts[0].startswith("session_") or not parts[1].startswith("generation_")
+                        or not name.lower().endswith(self.AUDIO_EXTENSIONS)):
+                    continue
+                generation_dir = os.path.abspath(os.path.join(self.sessions_dir, parts[0], parts[1]))
+                files.append({
+                    "path": path, "session": parts[0], "generation_dir": generation_dir,
+                    "kind": "stem" if "STEMS" in parts else "clip",
+                    "size": stat.st_size, "inode": (stat.st_dev, stat.st_ino),
+                    "mtime": stat.st_mtime, "last_used": max(stat.st_mtime, self.last_used.get(generation_dir, 0)),
+                })
+        return files, inodes, links
+
+    def _hash(self, file: dict) -> str:
+        key = (file["path"], file["size"], file["mtime"])
+        if key not in self.hashes:
+            digest = hashlib.sha256()
+            with open(file["path"], "rb") as handle:
+                for chunk in iter(lambda: handle.read(2 ** 20), b""):
+                    digest.update(chunk)
+            self.hashes[key] = digest.hexdigest()
+        return self.hashes[key]
+
+    @staticmethod
+    def _unlink(file: dict, links: dict) -> int:
+        """
+        Drops one link of the inode of a file, returns the bytes freed (once its last link is gone).
+        """
+        links[file["inode"]] -= 1
+        return file["size"] if links[file["inode"]] == 0 else 0
+
+    def _deduplicate(self, files: list, links: dict) -> tuple[int, int]:
+        # Only files of the same size can be identical, only those are hashed
+        by_size = {}
+        for file in files:
+            by_size.setdefault(file["size"], []).append(file)
+        reclaimed, count = 0, 0
+        for same_size in by_size.values():
+            if len({file["inode"] for file in same_size}) < 2:
+                continue
+            by_hash = {}
+            for file in same_size:
+                by_hash.setdefault(self._hash(file), []).append(file)
+            for duplicates in by_hash.values():
+                original = duplicates[0]
+                for file in duplicates[1:]:
+                    if file["inode"] == original["inode"]:
+                        continue
+                    tmp_path = f"{file['path']}.dedup"
+                    os.link(original["path"], tmp_path)
+                    os.replace(tmp_path, file["path"])  # Atomic: the path always points to complete audio
+                    reclaimed += self._unlink(file, links)
+                    file["inode"] = original["inode"]
+                    links[original["inode"]] += 1
+                    count += 1
+        return reclaimed, count
+
+    @staticmethod
+    def _transcode(file: dict, links: dict):
+        """
+        Replaces a WAV file with a FLAC file of the same audio.
+        """
+        flac_path = f"{os.path.splitext(file['path'])[0]}.flac"
+        tmp_path = f"{flac_path}.tmp"
+        wav, sample_rate = torchaudio.load(file["path"])
+        torchaudio.save(tmp_path, wav, sample_rate, format="flac", bits_per_sample=16)
+        os.utime(tmp_path, (file["mtime"], file["mtime"]))  # Keeps its age
+        os.replace(tmp_path, flac_path)
+        os.remove(file["path"])
+        links.pop(file["inode"], None)
+        stat = os.stat(flac_path)
+        file.update(path=flac_path, size=stat.st_size, inode=(stat.st_dev, stat.st_ino))
+        links[file["inode"]] = stat.st_nlink
+
+    def _evict(self, file: dict, links: dict) -> int:
+        """
+        Deletes a file (and the folders it leaves empty), returns the bytes freed.
+        """
+        try:
+            os.remove(file["path"])
+        except OSError:
+            return 0  # Already removed
+        try:
+            os.removedirs(os.path.dirname(file["path"]))
+        except OSError:
+            pass  # The folder still holds other files
+        file["evicted"] = True
+        return self._unlink(file, links)
+
+    def run_once(self) -> dict:
+        """
+        Runs one pass, returns the report of the space used and reclaimed.
+        """
+        start_time = time.time()
+        files, inodes, links = self._scan()
+        used_before = sum(inodes.values())
+        now = time.time()
+        # Hashes of files that were deleted or changed since the last pass are not needed anymore
+        current = {(file["path"], file["size"], file["mtime"]) for file in files}
+        self.hashes = {key: digest for key, digest in self.hashes.items() if key in current}
+
+        # Generations shown in an open session, or used recently, are never touched
+        while True:
+            try:
+                sessions = list(live_sessions)
+                break
+            except RuntimeError:
+                continue  # A session was opened meanwhile
+        protected = {os.path.abspath(os.path.join(session.dir, f"generation_{session.displayed_generation_id}"))
+                     for session in sessions}
+        candidates = [file for file in files
+                      if file["generation_dir"] not in protected and now - file["last_used"] > self.protect_s]
+
+        reclaimed = dict.fromkeys(self.totals, 0)
+        counts = dict.fromkeys(self.totals, 0)
+        reclaimed["deduplicated"], counts["deduplicated"] = self._deduplicate(files, links)
+
+        if self.cold_after_s is not None:
+            for file in candidates:
+                if (file["path"].lower().endswith(".wav") and links[file["inode"]] == 1
+                        and now - file["last_used"] > self.cold_after_s):
+                    try:
+                        old_size = file["size"]
+                        self._transcode(file, links)
+                        reclaimed["transcoded"] += old_size - file["size"]
+                        counts["transcoded"] += 1
+                    except Exception as e:
+                        logging.warning(f"Could not transcode {file['path']}: {e}")
+
+        if self.max_age_s is not None:
+            for file in candidates:
+                if now - file["last_used"] > self.max_age_s:
+                    reclaimed["evicted_age"] += self._evict(file, links)
+                    counts["evicted_age"] += 1
+
+        # Least recently used first, stems before clips
+        candidates = sorted((file for file in candidates if not file.get("evicted")),
+                            key=lambda file: (file["kind"] != "stem", file["last_used"]))
+        # Hardlinks of the same inode in a session are counted once
+        session_links = {}
+        session_usage = {}
+        for file in files:
+            if not file.get("evicted"):
+                key = (file["session"], file["inode"])
+                if key not in session_links:
+                    session_usage[file["session"]] = session_usage.get(file["session"], 0) + file["size"]
+                session_links[key] = session_links.get(key, 0) + 1
+        used = used_before - sum(reclaimed.values())
+        for file in candidates:
+            over_session = session_usage[file["session"]] > self.session_quota
+            if not over_session and used <= self.global_quota:
+                continue
+            inode = file["inode"]
+            freed = self._evict(file, links)
+            if not file.get("evicted"):
+                continue
+            session_links[(file["session"], inode)] -= 1
+            if session_links[(file["session"], inode)] == 0:
+                session_usage[file["session"]] -= file["size"]
+            used -= freed
+            reclaimed["evicted_quota"] += freed
+            counts["evicted_quota"] += 1
+
+        for key, value in reclaimed.items():
+            self.totals[key] += value
+        with self.lock:
+            self.last_used = {path: used_at for path, used_at in self.last_used.items()
+                              if now - used_at < (self.max_age_s or self.protect_s) + self.protect_s}
+        report = {
+            "used_bytes_before": used_before,
+            "used_bytes": sum(self._scan()[1].values()),
+            "global_quota_bytes": self.global_quota,
+            "reclaimed_bytes": reclaimed,
+            "files": counts,
+            "reclaimed_bytes_since_start": dict(self.totals),
+            "duration_s": round(time.time() - start_time, 2),
+        }
+        stage_metrics.observe("storage", "pass", time.time() - start_time)
+        logging.info(f"Storage manager pass: {report}")
+        self.last_report = report
+        return report
+
+
+storage_manager = StorageManager(os.path.join(BASE_DIR, "Sessions"), STORAGE_GLOBAL_QUOTA_GB, STORAGE_SESSION_QUOTA_GB,
+                                 STORAGE_MAX_AGE_DAYS, STORAGE_COLD_AFTER_H, STORAGE_PROTECT_H)
 
 # Separate tracks with demucs
-def separate_tracks(file_audio_path: str, generation_id: int, clip_index: int) -> List[Optional[str]]:
-    
-    if not os.path.exists(file_audio_path):
-        print("Error: file not found")
-        return [None] * 5
+def separate_tracks(session: SessionState, file_audio_path: str, generation_id: int, clip_index: int) -> List[Optional[str]]:
+    return separate_tracks_batch(session, [file_audio_path], generation_id, [clip_index])[0]
+
+# Separate several tracks of the same generation with a single demucs invocation
+def separate_tracks_batch(session: SessionState, file_audio_paths: List[str], generation_id: int,
+                          clip_indices: List[int]) -> List[List[Optional[str]]]:
 
     # subfolder to save generation output
-    generation_dir = os.path.join(CURRENT_SESSION_DIR, f"generation_{generation_id}")
+    generation_dir = os.path.join(session.dir, f"generation_{generation_id}")
+    storage_manager.touch(generation_dir)  # Not cleaned up while it is separated
+
+    # Clips just generated may still be written in the background, their audio buffer is used meanwhile
+    buffers = {idx: audio_buffers.find(path, generation_dir, clip_indices[idx]) for idx, path in enumerate(file_audio_paths)}
+
+    results = [[None] * 5 for _ in file_audio_paths]
+    valid = [idx for idx, path in enumerate(file_audio_paths) if os.path.exists(path) or buffers[idx] is not None]
+    if len(valid) < len(file_audio_paths):
+        print("Error: file not found")
+    if not valid:
+        return results
+
     separation_dir = os.path.join(generation_dir, f"STEMS")
     os.makedirs(separation_dir, exist_ok=True)
 
-    # Runs demucs to separate tracks
-    cmd = [
-        sys.executable, "-m", "demucs.separate",
-        "-o", separation_dir,  # Demucs-generated output
-        "-n", "htdemucs_6s",   #  Demucs model version
-        file_audio_path    # File to which separation is applied
-    ]
-    print(f"Apply separation to file: {file_audio_path}")
-    p = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE)
-    copy_process_streams(p)
-    p.wait()
+    # Output path directories, same layout as the one generated by demucs.separate
+    output_dirs = {
+        idx: os.path.join(separation_dir, SEPARATION_MODEL, os.path.splitext(os.path.basename(file_audio_paths[idx]))[0])
+        for idx in valid
+    }
 
-    if p.returncode != 0:
-        print("Error during separation.")
-        return [None] * 5
+    # Reuse the stems of clips whose audio was already separated
+    start_time = time.time()
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    job_id = next(separation_job_ids)
+    fingerprints = {}
+    to_separate = []
+    for idx in valid:
+        if buffers[idx] is not None and not buffers[idx].written.done():
+            to_separate.append(idx)  # Still being written: new audio, fingerprinted once on disk
+            continue
+        with stage_metrics.span("separation", "cache_lookup"):
+            fingerprints[idx] = separation_cache.fingerprint(file_audio_paths[idx])
+            restored = separation_cache.restore(fingerprints[idx], output_dirs[idx])
+        if restored:
+            results[idx] = stem_paths(output_dirs[idx])
+        else:
+            to_separate.append(idx)
+    session.log.info(f"Separation job #{job_id}: {len(valid) - len(to_separate)} clips reused from cache, {len(to_separate)} to separate. Cache stats: {separation_cache.stats()}")
+    if not to_separate:
+        elapsed_time = round(time.time() - start_time, 2)
+        session.log.info(f"Separation job #{job_id} completed in {elapsed_time} seconds, all clips from cache")
+        record_separation(session, generation_id, timestamp, len(valid), len(valid), elapsed_time)
+        return results
 
-    # Output path directory generated by DEMUCS
-    demucs_output_dir = os.path.join(separation_dir, "htdemucs_6s", os.path.splitext(os.path.basename(file_audio_path))[0])
-    
-    # paths of the last files generated by demucs
-    stems = ["drums", "bass", "guitar", "piano", "other"]
-    final_paths = [os.path.join(demucs_output_dir, f"{stem}.wav") for stem in stems]
+    # Runs demucs to separate tracks
+    session.log.info(f"Separation job #{job_id} started for generation #{generation_id}, clips {[clip_indices[idx] + 1 for idx in to_separate]}")
+    for idx in to_separate:
+        print(f"Apply separation to file: {file_audio_paths[idx]}")
+    try:
+        with separation_slots:
+            with stage_metrics.span("separation", "decoding"):
+                clips = [separation_engine.read_clip(file_audio_paths[idx], generation_dir, clip_indices[idx]) for idx in to_separate]
+            separations, samplerate = workers.call("separate", clips)
+    except Exception as e:
+        session.log.error(f"Separation job #{job_id} failed: {e}")
+        print("Error during separation.")
+        return results
 
-    # Checks that files ( None for missing files)
-    return [path if os.path.exists(path) else None for path in final_paths]
+    # The stems of all clips are encoded in parallel
+    separation_time = time.time() - start_time
+    writes = {idx: separation_engine.save_stems(stems, output_dirs[idx], samplerate) for idx, stems in zip(to_separate, separations)}
+    for idx in to_separate:
+        try:
+            with stage_metrics.span("separation", "disk_write"):
+                for future in writes[idx]:
+                    future.result()
+        except Exception as e:
+            session.log.error(f"Saving stems failed: {e}")
+            print("Error during separation.")
+            continue
+
+        results[idx] = stem_paths(output_dirs[idx])
+        if idx not in fingerprints:
+            if buffers[idx].written.exception() is not None:
+                continue  # The clip never reached the disk, nothing to fingerprint
+            fingerprints[idx] = separation_cache.fingerprint(file_audio_paths[idx])
+        separation_cache.store(fingerprints[idx], output_dirs[idx])
+
+    elapsed_time = round(time.time() - start_time, 2)
+    session.log.info(f"Separation job #{job_id} completed in {elapsed_time} seconds (post-processing {elapsed_time - separation_time:.2f} seconds)")
+    record_separation(session, generation_id, timestamp, len(valid), len(valid) - len(to_separate), elapsed_time)
+
+    return results
+
+# Metrics and history of a separation job, also when all its clips come from the cache
+def record_separation(session: SessionState, generation_id: int, timestamp: str, clips: int, cached: int,
+                      elapsed_time: float):
+    stage_metrics.observe("separation", "total", elapsed_time)
+    try:
+        session_store.add_separation(session.name, generation_id, timestamp, clips, cached, elapsed_time)
+    except Exception as e:
+        print(f" Error writing separation to the session store: {e}")
 
-def separate_and_path_check(file_audio_path: Optional[str], generation_id: int, clip_index: int) -> tuple[Optional[str], ...]:
+def separate_and_path_check(session: SessionState, file_audio_path: Optional[str], generation_id: int,
+                            clip_index: int) -> tuple[Optional[str], ...]:
     """
     Check and separate an audio file. Returns the paths of the separate tracks.
     """
@@ -334,238 +2437,485 @@ def separate_and_path_check(file_audio_path: Optional[str], generation_id: int,
         errore = "Error: No valid tracks found for separation. Generate music first!"
         return None, None, None, None, None, errore
 
-    output_files = separate_tracks(file_audio_path, generation_id, clip_index)
+    output_files = separate_tracks(session, file_audio_path, generation_id, clip_index)
     return *output_files, ""
 
-def separate_all_clips(audio_clip_1: Optional[str], audio_clip_2: Optional[str], audio_clip_3: Optional[str], generation_id: int) -> tuple:
+
+# Separation buttons: they work on the generation shown in the browser session
+def separate_displayed_clip(session: Optional[SessionState], file_audio_path: Optional[str],
+                            clip_index: int, enqueued_at: Optional[float] = None) -> tuple[Optional[str], ...]:
+    observe_queue_wait("separation", enqueued_at)
+    if session is None:
+        return None, None, None, None, None, SESSION_NOT_READY
+    return separate_and_path_check(session, file_audio_path, session.displayed_generation_id, clip_index)
+
+
+def separate_displayed_clips(session: Optional[SessionState], audio_clip_1: Optional[str], audio_clip_2: Optional[str],
+                             audio_clip_3: Optional[str], enqueued_at: Optional[float] = None) -> tuple:
+    observe_queue_wait("separation", enqueued_at)
+    if session is None:
+        return (None,) * 15
+    return separate_all_clips(session, audio_clip_1, audio_clip_2, audio_clip_3, session.displayed_generation_id)
+
+
+def separate_all_clips(session: SessionState, audio_clip_1: Optional[str], audio_clip_2: Optional[str],
+                       audio_clip_3: Optional[str], generation_id: int) -> tuple:
     """
     Automatic separation of all generated audio clips.
     """
-    global total_tracks_separated, total_tracks_generated
+    session.start()
 
+    # All present clips go through the separation model as one batch
+    clips = [audio_clip_1, audio_clip_2, audio_clip_3]
+    present = [idx for idx, clip in enumerate(clips) if clip]
+    separations = separate_tracks_batch(session, [clips[idx] for idx in present], generation_id, present)
+    separation_by_clip = dict(zip(present, separations))
 
     separation_results = []
-    for idx, clip in enumerate([audio_clip_1, audio_clip_2, audio_clip_3]):
+    for idx, clip in enumerate(clips):
         if clip:
-            separation = separate_tracks(clip, generation_id, idx)
+            separation = separation_by_clip[idx]
             separation = [str(path) if path else None for path in separation]  # Ensure paths are strings
             separation_results.extend(separation)
-            total_tracks_separated += 1
 
         else:
             separation_results.extend([None, None, None, None, None])  
 
+    total_tracks_generated, total_tracks_separated = session.count_tracks(separated=len(present))
+
     # Prevent division by zero and round percentage
     separation_usage_rate = round((total_tracks_separated / total_tracks_generated * 100), 2) if total_tracks_generated > 0 else 0
 
-    logging.info(f"Session Summary: {total_tracks_generated} tracks generated, {total_tracks_separated} separated, {separation_usage_rate:.2f}% usage rate.")
+    session.log.info(f"Session Summary: {total_tracks_generated} tracks generated, {total_tracks_separated} separated, {separation_usage_rate:.2f}% usage rate.")
 
     # Define paths for CSV files
-    session_csv = os.path.join(CURRENT_SESSION_DIR, "session.csv")
+    session_csv = os.path.join(session.dir, "session.csv")
     global_csv = os.path.join(BASE_DIR, "Sessions", "all_sessions.csv")
 
-    # Write to session.csv safely
-    try:
-        file_exists = os.path.exists(session_csv) and os.stat(session_csv).st_size > 0
-        with open(session_csv, mode="a", newline="") as file:
-            writer = csv.writer(file)
-            if not file_exists:  # If file is new, write headers
-                writer.writerow(["Session Summary", "Tracks Generated", "Tracks Separated", "Separation Usage Rate (%)"])
-            writer.writerow(["Session Summary", total_tracks_generated, total_tracks_separated, f"{separation_usage_rate:.2f}%"])
-        print(f" Session summary saved in {session_csv}")  # Debugging print
-    except Exception as e:
-        print(f" Error writing session summary to {session_csv}: {e}")
-
-    # Read previous session statistics
-    previous_sessions = []
-    try:
-        if os.path.exists(global_csv) and os.stat(global_csv).st_size > 0:
-            with open(global_csv, mode="r", newline="") as file:
-                reader = csv.reader(file)
-                next(reader)  # Skip header
-                for row in reader:
-                    if len(row) >= 4:
-                        previous_sessions.append(float(row[3].replace('%', '')))
-    except Exception as e:
-        print(f" Warning: Could not read {global_csv}: {e}")
-
-    # Compute overall separation rate correctly
-    all_sessions_separation_rate = round(
-        (sum(previous_sessions) + separation_usage_rate) / (len(previous_sessions) + 1),
-        2
-    ) if previous_sessions else separation_usage_rate
+    # Write to session.csv (in the background, errors are reported by the metrics writer)
+    metrics_writer.write_csv(
+        session_csv,
+        ["Session Summary", total_tracks_generated, total_tracks_separated, f"{separation_usage_rate:.2f}%"],
+        header=["Session Summary", "Tracks Generated", "Tracks Separated", "Separation Usage Rate (%)"]
+    )
 
-    # Write to global CSV safely
+    # Overall separation rate, maintained incrementally by the session store
     try:
-        file_exists = os.path.exists(global_csv) and os.stat(global_csv).st_size > 0
-        with open(global_csv, mode="a", newline="") as file:
-            writer = csv.writer(file)
-            if not file_exists:  # If empty, write headers
-                writer.writerow(["Session Summary", "Tracks Generated", "Tracks Separated", "Overall Separation Usage Rate (%)"])
-            writer.writerow(["Session Summary", total_tracks_generated, total_tracks_separated, f"{all_sessions_separation_rate:.2f}%"])
-        print(f" Updated all_sessions.csv with new average separation rate.")
+        all_sessions_separation_rate = session_store.add_session_summary(
+            session.name, datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            total_tracks_generated, total_tracks_separated, separation_usage_rate
+        )
     except Exception as e:
-        print(f" Error updating all_sessions.csv: {e}")
+        print(f" Error writing session summary to the session store: {e}")
+        all_sessions_separation_rate = separation_usage_rate
+
+    # Write to global CSV
+    metrics_writer.write_csv(
+        global_csv,
+        ["Session Summary", total_tracks_generated, total_tracks_separated, f"{all_sessions_separation_rate:.2f}%"],
+        header=["Session Summary", "Tracks Generated", "Tracks Separated", "Overall Separation Usage Rate (%)"]
+    )
 
     return tuple(separation_results)
 
 
 
 # Graphical interface
-with gr.Blocks() as demo:
-
-    # Main area with Tabs
-    with gr.Tabs():
+def build_interface() -> gr.Blocks:
+    with gr.Blocks() as demo:
+        session_state = gr.State(None)  # SessionState of this browser session, created when the page loads
+        generation_enqueued_at = gr.State(None)  # When the last generation request entered the queue
+        separation_enqueued_at = gr.State(None)  # When the last separation request entered the queue
+
+        # Main area with Tabs
+        with gr.Tabs():
         
-        # Tab for music generation
-        with gr.Tab("Generation") as tab_generation:
-            title = gr.Markdown(texts[current_language]["title"])
-            counter_label = gr.Markdown(f"{texts[current_language]['counter_label']} {generation_count}")
-
-            with gr.Row():
-                description = gr.Textbox(
-                    lines=2,
-                    placeholder=texts[current_language]["description_placeholder"],
-                    label=texts[current_language]["description_label"],
-                )
-            with gr.Row():
-                model_choice = gr.Radio(
-                    choices=["small", "medium", "large"],
-                    value="small",
-                    label=texts[current_language]["model_label"],
-                )
-            with gr.Row():
-                duration = gr.Slider(
-                    minimum=1, maximum=30, value=10, step=1,
-                    label=texts[current_language]["duration_label"]
-                )
-            with gr.Row():
+            # Tab for music generation
+            with gr.Tab("Generation") as tab_generation:
+                title = gr.Markdown(texts[current_language]["title"])
+                counter_label = gr.Markdown(f"{texts[current_language]['counter_label']} 0")
+
+                with gr.Row():
+                    description = gr.Textbox(
+                        lines=2,
+                        placeholder=texts[current_language]["description_placeholder"],
+                        label=texts[current_language]["description_label"],
+                    )
+                with gr.Row():
+                    model_choice = gr.Radio(
+                        choices=["small", "medium", "large"],
+                        value="small",
+                        label=texts[current_language]["model_label"],
+                    )
+                with gr.Row():
+                    seed = gr.Number(
+                        value=-1, precision=0,
+                        label="Seed (-1 for random, any other value gives repeatable results)"
+                    )
+                with gr.Row():
+                    stream = gr.Checkbox(value=False, label="Stream audio while generating")
+                    auto_separate = gr.Checkbox(value=False, label="Separate clips automatically")
+                with gr.Row():
+                    duration = gr.Slider(
+                        minimum=1, maximum=MAX_DURATION_S, value=10, step=1,
+                        label=texts[current_language]["duration_label"]
+                    )
+                with gr.Row():
                 
-                generate_button = gr.Button(
-                    texts[current_language]["generate_button"],
-                    elem_id="generate_button",
-                    variant="primary"
+                    generate_button = gr.Button(
+                        texts[current_language]["generate_button"],
+                        elem_id="generate_button",
+                        variant="primary"
+                    )
+                with gr.Row():
+                    output_audio = [gr.Audio(type='filepath', label=f"Clip Audio {i+1}",show_download_button=True) for i in range(3)]
+                with gr.Row():
+                    # Streamed generations play here while they are generated, segment after segment
+                    live_audio = [gr.Audio(label=f"Live {i+1}", streaming=True, autoplay=i == 0, interactive=False) for i in range(3)]
+
+
+            # Tab for tracks separation
+            with gr.Tab("Separation") as tab_separation:
+                separation_title = gr.Markdown(texts[current_language]["separation_title"])
+
+                separate_buttons = []  # list for separation-related buttons
+                stems_outputs = []
+
+                separate_all_button = gr.Button(texts[current_language].get("separate_all_button", "Separate All"), variant="primary")
+
+                for i in range(3):  # For each generated audio clip
+                    with gr.Group():
+                        with gr.Row():
+                            separate_button = gr.Button(
+                                f"{texts[current_language]['separate_button']} {i+1}"
+                            )
+                            separate_buttons.append(separate_button)  # Save buttons
+
+                        with gr.Row():
+                            # Output for separated stems (Drums, Bass, ecc.)
+                            stem_audios = [
+                                gr.Audio(label=stem.capitalize(), type='filepath')
+                                for stem in ["Drums", "Bass", "Guitar", "Piano", "Other"]
+                            ]
+                            stems_outputs.append(stem_audios)
+                        separation_output = gr.Markdown("")  # Error messages
+
+                        # Connect single separation buttons (clip index bound now, generation read from the session)
+                        separate_button.click(
+                            fn=enqueue_time, outputs=[separation_enqueued_at], queue=False,
+                        ).then(
+                            fn=lambda file_audio_path, session, enqueued_at, clip_index=i: separate_displayed_clip(
+                                session, file_audio_path, clip_index, enqueued_at),
+                            inputs=[output_audio[i], session_state, separation_enqueued_at],
+                            outputs=stem_audios + [separation_output],  # Output audio + messages
+                            concurrency_limit=SEPARATION_CONCURRENCY,
+                            concurrency_id="separation",  # All separation buttons share the separation workers
+                        )
+
+                # Link button "Separate All" (once, after the outputs of all clips exist)
+                separate_all_button.click(
+                    fn=enqueue_time, outputs=[separation_enqueued_at], queue=False,
+                ).then(
+                    fn=lambda clip1, clip2, clip3, session, enqueued_at: separate_displayed_clips(
+                        session, clip1, clip2, clip3, enqueued_at),
+                    inputs=[output_audio[0], output_audio[1], output_audio[2], session_state, separation_enqueued_at],
+                    outputs=[stem_audio for audio_group in stems_outputs for stem_audio in audio_group],
+                    concurrency_limit=SEPARATION_CONCURRENCY,
+                    concurrency_id="separation",
                 )
-            with gr.Row():
-                output_audio = [gr.Audio(type='filepath', label=f"Clip Audio {i+1}",show_download_button=True) for i in range(3)]
-            
+
+            # Generation is linked here, once the stems it can separate automatically exist
+
             # Linking the Button to the Textbox
             description.submit(
+                fn=enqueue_time, outputs=[generation_enqueued_at], queue=False,  # Outside the queue, to measure the wait in it
+            ).then(
                 fn=generate_music,  # Funzione di generazione
-                inputs=[description, duration, model_choice],  # function input
-                outputs=output_audio + [counter_label],  # function output
+                inputs=[session_state, description, duration, model_choice, seed, stream, auto_separate, generation_enqueued_at],  # function input
+                outputs=output_audio + [counter_label] + [stem_audio for audio_group in stems_outputs for stem_audio in audio_group] + live_audio,  # function output
+                concurrency_limit=GENERATION_CONCURRENCY,
+                concurrency_id="generation",  # Shares the generation workers with the button below
+            ).then(
+                fn=deliver_separations,  # Stems of the automatic separations, once the generation has ended
+                inputs=[session_state],
+                outputs=[stem_audio for audio_group in stems_outputs for stem_audio in audio_group],
+                concurrency_limit=None,  # Only waits, the separations run on the separation workers
             )
 
             # Linking the Button to music generation
             generate_button.click(
+                fn=enqueue_time, outputs=[generation_enqueued_at], queue=False,
+            ).then(
                 fn=generate_music,
-                inputs=[description, duration, model_choice],
-                outputs=output_audio + [counter_label],  # Three audios + counter
+                inputs=[session_state, description, duration, model_choice, seed, stream, auto_separate, generation_enqueued_at],
+                outputs=output_audio + [counter_label] + [stem_audio for audio_group in stems_outputs for stem_audio in audio_group] + live_audio,  # Three audios + counter + stems + live players
+                concurrency_limit=GENERATION_CONCURRENCY,
+                concurrency_id="generation",
+            ).then(
+                fn=deliver_separations,
+                inputs=[session_state],
+                outputs=[stem_audio for audio_group in stems_outputs for stem_audio in audio_group],
+                concurrency_limit=None,
             )
 
-        # Tab for tracks separation
-        with gr.Tab("Separation") as tab_separation:
-            separation_title = gr.Markdown(texts[current_language]["separation_title"])
+            # Tab for history
+        
+            with gr.Tab("History", visible=False) as tab_history:
+                gr.Markdown("### Generation history")
+
+                with gr.Row():
+                    history_query = gr.Textbox(label="Search descriptions", placeholder="Words or beginnings of words")
+                    history_page = gr.Number(value=1, precision=0, minimum=1, label="Page")
+
+                # Dataset to show a page of generations (only ids and descriptions, no audio)
+                history_list = gr.Dataset(components=[
+                    gr.Textbox(label="ID Generation"),
+                    gr.Textbox(label="Session"),
+                    gr.Textbox(label="Time"),
+                    gr.Textbox(label="Description")
+                ], samples=[], samples_per_page=HISTORY_PAGE_SIZE)
+                history_info = gr.Markdown("")
+
+                # Area to show audio files selected from history
+                with gr.Row():
+                    history_audio = [gr.Audio(type='filepath', label=f"Clip Audio {i+1}") for i in range(3)]
+
+                # Buttons to update history and move between pages
+                with gr.Row():
+                    previous_button = gr.Button("Previous page")
+                    update_button = gr.Button("History Update")
+                    next_button = gr.Button("Next page")
+
+                # Button to update history (a new search starts from the first page)
+                for trigger, step in [(update_button.click, 0), (history_page.submit, 0),
+                                      (previous_button.click, -1), (next_button.click, 1)]:
+                    trigger(
+                        fn=lambda query, page, step=step: history_update(query, page, step),
+                        inputs=[history_query, history_page],
+                        outputs=[history_list, history_page, history_info],  # Generation list
+                    )
+                history_query.submit(
+                    fn=lambda query: history_update(query, 1),
+                    inputs=[history_query],
+                    outputs=[history_list, history_page, history_info],
+                )
 
-            separate_buttons = []  # list for separation-related buttons
-            stems_outputs = []
+                # Load a new generation
+                load_id = gr.Number(label="Generation ID", precision=0)
+                load_button = gr.Button("Load generation")
 
-            separate_all_button = gr.Button(texts[current_language].get("separate_all_button", "Separate All"), variant="primary")
+                load_button.click(
+                    fn=load_from_history,
+                    inputs=[load_id],
+                    outputs=history_audio,  # Show audio files of the selected generation
+                )
 
-            for i in range(3):  # For each generated audio clip
-                with gr.Group():
-                    with gr.Row():
-                        separate_button = gr.Button(
-                            f"{texts[current_language]['separate_button']} {i+1}"
-                        )
-                        separate_buttons.append(separate_button)  # Save buttons
-
-                    with gr.Row():
-                        # Output for separated stems (Drums, Bass, ecc.)
-                        stem_audios = [
-                            gr.Audio(label=stem.capitalize(), type='filepath')
-                            for stem in ["Drums", "Bass", "Guitar", "Piano", "Other"]
-                        ]
-                        stems_outputs.append(stem_audios)
-                    separation_output = gr.Markdown("")  # Error messages
-
-                    # Connect single separation buttons
-                    separate_button.click(
-                        fn=lambda file_audio_path=output_audio[i]: separate_and_path_check(file_audio_path,generation_count, i),
-                        inputs=[output_audio[i]],
-                        outputs=stem_audios + [separation_output],  # Output audio + messages
-                    )
+                # Clicking a row opens its generation
+                history_list.click(
+                    fn=load_history_row,
+                    inputs=[history_list],
+                    outputs=history_audio + [load_id],
+                )
 
+        # Spacing and button to change language
+        with gr.Row():
+            gr.Markdown(" ")
+        with gr.Row():
+            change_language_button = gr.Button(
+                texts[current_language]["change_language"],
+                elem_id="language_button",
+                variant="secondary"
+            )
 
-                    # Link button "Separate All"
-                    separate_all_button.click(
-                        fn=lambda clip1, clip2, clip3: separate_all_clips(clip1, clip2, clip3, generation_count),
-                        inputs=[output_audio[0], output_audio[1], output_audio[2]],
-                        outputs=[stem_audio for audio_group in stems_outputs for stem_audio in audio_group]
-                    )
+        # Connect language change
+        change_language_button.click(
+            fn=change_language,
+            inputs=[session_state],
+            outputs=[
+                title, # Updated title
+                change_language_button, # updated button
+                description, # Updated textbox
+                model_choice, # Updated radio
+                duration, # Updated slider
+                generate_button, # Updated generate music button
+                separation_title, # Updated track separation title
+                *separate_buttons, # Updated separation buttons
+            ],
+        )
 
-        # Tab for history
-        
-        with gr.Tab("History", visible=False) as tab_history:
-            gr.Markdown("### Generation history")
-
-            # Dataset to show list of generations
-            history_list = gr.Dataset(components=[
-                gr.Textbox(label="ID Generation"),
-                gr.Textbox(label="Description")
-            ])
-
-            # Area to show audio files selected from history
-            with gr.Row():
-                history_audio = [gr.Audio(type='filepath', label=f"Clip Audio {i+1}") for i in range(3)]
-
-            # Button to update history
-            update_button = gr.Button("History Update")
-
-            # Button to update history
-            update_button.click(
-                fn=history_update,
-                inputs=[],
-                outputs=[history_list],  # Generation list
-            )
+        # Each browser session gets its own state (folder and counters)
+        demo.load(fn=SessionState, inputs=[], outputs=[session_state])
 
-            # Load a new generation
-            load_id = gr.Number(label="Generation ID", precision=0)
-            load_button = gr.Button("Load generation")
+    return demo
 
-            load_button.click(
-                fn=load_from_history,
-                inputs=[load_id],
-                outputs=history_audio,  # Show audio files of the selected generation
-            )
 
-    # Spacing and button to change language
-    with gr.Row():
-        gr.Markdown(" ")
-    with gr.Row():
-        change_language_button = gr.Button(
-            texts[current_language]["change_language"],
-            elem_id="language_button",
-            variant="secondary"
-        )
+# Difference between a reference audio and an approximation of it
+def audio_difference(reference: torch.Tensor, test: torch.Tensor, sample_rate: int) -> dict:
+    length = min(reference.shape[-1], test.shape[-1])
+    reference, test = reference[..., :length].float(), test[..., :length].float()
+    snr = 10 * torch.log10(reference.pow(2).sum() / (reference - test).pow(2).sum().clamp_min(1e-12))
+    mel = torchaudio.transforms.MelSpectrogram(sample_rate, n_mels=64)
+    mel_distance = (torch.log(mel(reference) + 1e-5) - torch.log(mel(test) + 1e-5)).abs().mean()
+    return {"snr_db": round(float(snr), 2), "log_mel_distance": round(float(mel_distance), 4)}
 
-    # Connect language change
-    change_language_button.click(
-        fn=change_language,
-        inputs=[],
-        outputs=[
-            title, # Updated title
-            change_language_button, # updated button
-            description, # Updated textbox
-            model_choice, # Updated radio
-            duration, # Updated slider
-            generate_button, # Updated generate music button
-            separation_title, # Updated track separation title
-            *separate_buttons, # Updated separation buttons
-        ],
-    )
 
-# Run the interface
-print("Before demo.launch()")
-demo.launch(share=False, server_port=7860)
-print("After demo.launch()")
\ No newline at end of file
+def check_cpu_accuracy(model_name: str = "small", duration: int = 5,
+                       description: str = texts["english"]["description_placeholder"]) -> dict:
+    """
+    Compares the CPU models accelerated with the current CPU_* settings against their fp32
+    version on the same inputs, and reports the speed-up and the audio differences.
+    Musicgen decodes greedily here, so both versions produce the same tokens unless the
+    acceleration changes them.
+    """
+    configure_cpu_threads()
+    full_model_name = f"facebook/musicgen-{model_name}"
+    report = {}
+
+    def timed(function):
+        start_time = time.time()
+        with torch.inference_mode():
+            output = function()
+        return output, time.time() - start_time
+
+    params = dict(GENERATION_PARAMS, use_sampling=False)
+    outputs = {}
+    for name, musicgen in [("fp32", MusicGen.get_pretrained(full_model_name, device="cpu")),
+                           ("accelerated", accelerate_musicgen(MusicGen.get_pretrained(full_model_name, device="cpu")))]:
+        musicgen.set_generation_params(duration=duration, **params)
+        outputs[name] = timed(lambda: musicgen.generate([description]))
+    report["musicgen"] = {
+        **audio_difference(outputs["fp32"][0], outputs["accelerated"][0], musicgen.sample_rate),
+        "speedup": round(outputs["fp32"][1] / outputs["accelerated"][1], 2),
+    }
+
+    reference_model = get_model(SEPARATION_MODEL).eval()
+    accelerated_model = accelerate_demucs(get_model(SEPARATION_MODEL).eval())
+    wav = convert_audio(outputs["fp32"][0][0], musicgen.sample_rate, reference_model.samplerate, reference_model.audio_channels)
+    stems = {}
+    for name, demucs_model in [("fp32", reference_model), ("accelerated", accelerated_model)]:
+        with torch.autocast("cpu", dtype=torch.bfloat16, enabled=name == "accelerated" and CPU_PRECISION == "bf16"):
+            stems[name] = timed(lambda: apply_model(demucs_model, wav[None], device="cpu", split=True,
+                                                    overlap=SEPARATION_OVERLAP).float())
+    report["demucs"] = {
+        **audio_difference(stems["fp32"][0], stems["accelerated"][0], reference_model.samplerate),
+        "speedup": round(stems["fp32"][1] / stems["accelerated"][1], 2),
+    }
+
+    print(f"CPU accuracy check ({CPU_PRECISION}, compile={CPU_COMPILE}): {report}")
+    return report
+
+
+startup_times = {}  # Startup milestone -> seconds since the script started
+
+
+# Records (once) and reports the time a startup milestone was reached
+def record_startup(milestone: str):
+    elapsed = round(time.perf_counter() - STARTUP_TIME, 2)
+    if startup_times.setdefault(milestone, elapsed) is not elapsed:
+        return  # Already reached
+    stage_metrics.observe("startup", milestone, elapsed)
+    logging.info(f"Startup: {milestone.replace('_', ' ')} after {elapsed} seconds")
+    print(f"Startup: {milestone.replace('_', ' ')} after {elapsed} seconds")
+
+
+# Background warm-up once the port is open: loads the models and runs a short generation and separation
+def warm_up(model_names: List[str], inference: bool = True):
+    """
+    Loads the models in the background. With inference, also loads the separation model and runs
+    a short generation and separation, so the first request does not pay for the first run.
+    """
+    start_time = time.perf_counter()
+    try:
+        if not WORKERS:  # Remote workers load their own models
+            model_pool.preload(model_names)
+            if inference:
+                separation_engine.get_model()
+        if not inference:
+            logging.info(f"Models {model_names} preloaded in {time.perf_counter() - start_time:.2f} seconds")
+            return
+        wavs, sample_rate = workers.call("generate", model_names[0], WARMUP_DURATION_S, ["warm-up"], 0)
+        workers.call("separate", [(wavs[0], sample_rate)])
+    except Exception as e:
+        logging.error(f"Warm-up failed: {e}")
+        return
+    logging.info(f"Warm-up done in {time.perf_counter() - start_time:.2f} seconds")
+    record_startup("first_ready_generation")
+
+
+def main():
+    global WORKERS, workers
+
+    parser = argparse.ArgumentParser(description="Music generation (MusicGen) and track separation (Demucs) interface")
+    parser.add_argument("--port", type=int, default=SERVER_PORT, help="port of the interface")
+    parser.add_argument("--worker", metavar="HOST:PORT", help="run as a worker serving the jobs of the front ends, without interface")
+    parser.add_argument("--workers", metavar="HOST:PORT,...", help="send the jobs to these workers instead of running them in this process")
+    parser.add_argument("--no-warmup", action="store_true", help="do not run a generation after the port is open (PRELOAD_MODELS are still loaded)")
+    parser.add_argument("--check-cpu-accuracy", action="store_true", help="compare the accelerated CPU models with fp32 and exit")
+    parser.add_argument("--storage-report", action="store_true", help="run one pass of the storage manager, print its report and exit")
+    parser.add_argument("--export-csv", metavar="DIR", help="write the generations, separations and session summaries to CSV files in DIR and exit")
+    args = parser.parse_args()
+    if (args.worker or args.workers or WORKERS) and not WORKER_AUTHKEY:
+        parser.error("MUSIC_WORKER_AUTHKEY must be set to a secret shared by the front end and the workers")
+
+    if args.check_cpu_accuracy:
+        check_cpu_accuracy()
+        return
+
+    # Runs one pass of the storage manager and prints the space used and reclaimed
+    if args.storage_report:
+        setup_logging()
+        print(json.dumps(storage_manager.run_once(), indent=2))
+        return
+
+    # Exports the tables of the session store, e.g. for a spreadsheet
+    if args.export_csv:
+        session_store.export_csv(args.export_csv)
+        print(f"Session store exported to {args.export_csv}")
+        return
+
+    setup_logging()
+
+    # Worker mode: no interface, serves the jobs of the front ends
+    if args.worker:
+        if get_device() == "cpu":
+            configure_cpu_threads()
+        if METRICS_PORT:
+            stage_metrics.serve(int(args.worker.rsplit(":", 1)[1]) + 1)  # Next to the worker port
+        if PRELOAD_MODELS:
+            model_pool.preload(PRELOAD_MODELS)
+        serve_worker(args.worker)
+        return
+
+    # Front end dispatching the jobs to workers, instead of running them itself
+    if args.workers:
+        WORKERS = args.workers.split(",")
+        workers = create_worker_pool(WORKERS)
+
+    if METRICS_PORT:
+        stage_metrics.serve(METRICS_PORT)
+
+    # Build the history index (on the first start) in the background
+    threading.Thread(target=session_store.open, name="history-index", daemon=True).start()
+
+    # Keep Sessions/ within its quotas
+    if STORAGE_SCAN_INTERVAL_S:
+        storage_manager.start(STORAGE_SCAN_INTERVAL_S)
+
+    # Run the interface: only gradio is needed to open the port, torch and the models come after
+    demo = build_interface()
+    # Jobs wait in the queue until a worker of their pool is free; the interface shows queue position and ETA
+    demo.queue(max_size=MAX_QUEUE_SIZE)
+    demo.launch(share=False, server_port=args.port, prevent_thread_lock=True)
+    record_startup("port_open")
+
+    # Must run before any model is used: right after the port opens, before the warm-up starts
+    if not WORKERS and get_device() == "cpu":
+        configure_cpu_threads()
+    run_warm_up = WARMUP and not args.no_warmup
+    if run_warm_up or PRELOAD_MODELS:
+        threading.Thread(target=warm_up, args=(PRELOAD_MODELS or ["small"], run_warm_up), name="warm-up", daemon=True).start()
+    demo.block_thread()
+
+
+if __name__ == "__main__":
+    main()